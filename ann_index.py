@@ -0,0 +1,184 @@
+import os
+import logging
+import threading
+import numpy as np
+
+import db
+import encoding_store
+
+# Below this many encodings brute force search is fast enough, no index is built
+MIN_ROWS = 20000
+NPROBE = 8
+TRAIN_SAMPLE = 100000
+ASSIGN_CHUNK = 65536
+
+_indexes = {}
+_index_lock = threading.Lock()
+
+def nearest_centroids(encodings, centroids, centroids_sq=None):
+    """Index of the closest centroid for every row, computed in chunks."""
+    if centroids_sq is None:
+        centroids_sq = np.einsum("ij,ij->i", centroids, centroids)
+    labels = np.empty(len(encodings), dtype=np.int64)
+    for start in range(0, len(encodings), ASSIGN_CHUNK):
+        chunk = np.asarray(encodings[start:start + ASSIGN_CHUNK], dtype=np.float32)
+        # |x|^2 is the same for every centroid, it does not change the argmin
+        labels[start:start + len(chunk)] = np.argmin(centroids_sq[None, :] - 2.0 * (chunk @ centroids.T), axis=1)
+    return labels
+
+def kmeans(data, k, iterations=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = nearest_centroids(data, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.stack([np.bincount(labels, weights=data[:, d], minlength=k) for d in range(data.shape[1])], axis=1)
+        empty = counts == 0
+        centroids[~empty] = (sums[~empty] / counts[~empty, None]).astype(np.float32)
+        # Reseed empty clusters on random points instead of leaving them dead
+        centroids[empty] = data[rng.choice(len(data), int(empty.sum()), replace=False)]
+    return centroids
+
+class IVFIndex:
+    """Inverted file index over the rows of the encoding store.
+
+    A k-means coarse quantizer splits the encodings into nlist cells, a query
+    only computes exact distances against the rows of its nprobe closest cells.
+    The index only holds store row numbers, vectors are read from the memmap.
+    """
+
+    def __init__(self, centroids, lists=None, ntotal=0):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.centroids_sq = np.einsum("ij,ij->i", self.centroids, self.centroids)
+        self.lists = lists if lists is not None else [np.empty(0, dtype=np.int64) for _ in range(len(self.centroids))]
+        # Store rows [0, ntotal) are indexed
+        self.ntotal = ntotal
+        self.lock = threading.RLock()
+
+    @classmethod
+    def train(cls, store, nlist=None, iterations=20, seed=0):
+        matrix = store.matrix()
+        if nlist is None:
+            nlist = max(1, int(4 * np.sqrt(len(matrix))))
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(len(matrix), min(len(matrix), max(TRAIN_SAMPLE, nlist)), replace=False))
+        sample = np.asarray(matrix[sample_rows], dtype=np.float32)
+        index = cls(kmeans(sample, nlist, iterations, seed))
+        index.update(store)
+        return index
+
+    def __len__(self):
+        return self.ntotal
+
+    def add(self, rows, encodings):
+        labels = nearest_centroids(encodings, self.centroids, self.centroids_sq)
+        order = np.argsort(labels, kind="stable")
+        labels, rows = labels[order], np.asarray(rows, dtype=np.int64)[order]
+        cells, starts = np.unique(labels, return_index=True)
+        with self.lock:
+            for cell, part in zip(cells, np.split(rows, starts[1:])):
+                self.lists[cell] = np.concatenate([self.lists[cell], part])
+
+    def update(self, store):
+        """Index the store rows appended since the last update, returns how many were added."""
+        matrix = store.matrix()
+        added = 0
+        with self.lock:
+            for start in range(self.ntotal, len(matrix), ASSIGN_CHUNK):
+                stop = min(start + ASSIGN_CHUNK, len(matrix))
+                self.add(np.arange(start, stop), matrix[start:stop])
+                added += stop - start
+            self.ntotal = len(matrix)
+        return added
+
+    def search(self, store, query, k=10, nprobe=NPROBE):
+        """k nearest store rows of one query encoding, returns (rows, distances) sorted by distance."""
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        cell_dist = self.centroids_sq - 2.0 * (self.centroids @ query)
+        cells = np.argpartition(cell_dist, min(nprobe, len(cell_dist)) - 1)[:nprobe]
+        with self.lock:
+            candidates = np.concatenate([self.lists[cell] for cell in cells])
+        if candidates.size == 0:
+            return candidates, np.empty(0, dtype=np.float32)
+        candidates.sort()
+        vectors = np.asarray(store.matrix()[candidates], dtype=np.float32)
+        distances = np.linalg.norm(vectors - query, axis=1)
+        top = np.argsort(distances)[:k] if len(distances) <= k else np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        return candidates[top], distances[top]
+
+    def save(self, path):
+        with self.lock:
+            lengths = np.array([len(rows) for rows in self.lists], dtype=np.int64)
+            rows = np.concatenate(self.lists) if self.lists else np.empty(0, dtype=np.int64)
+            ntotal = self.ntotal
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, centroids=self.centroids, lengths=lengths, rows=rows, ntotal=ntotal)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            offsets = np.concatenate([[0], np.cumsum(data["lengths"])])
+            rows = data["rows"]
+            lists = [rows[offsets[i]:offsets[i + 1]].copy() for i in range(len(offsets) - 1)]
+            return cls(data["centroids"], lists, int(data["ntotal"]))
+
+def index_path(encoder_id):
+    return f"{os.path.splitext(db.DB_PATH)[0]}_ivf_{encoder_id}.npz"
+
+def get_index(store):
+    """Return the index of a store, None until the library is big enough to need one."""
+    path = index_path(store.encoder_id)
+    with _index_lock:
+        if path not in _indexes and os.path.exists(path):
+            try:
+                _indexes[path] = IVFIndex.load(path)
+            except Exception as e:
+                logging.error(f"Error loading ANN index {path}, it will be rebuilt: {e}")
+        return _indexes.get(path)
+
+def update_index(store=None):
+    """Bring the index up to date with a store (default: current encoder), building it once the store reaches MIN_ROWS."""
+    if store is None:
+        store = encoding_store.get_store()
+    index = get_index(store)
+    if index is None:
+        if len(store) < MIN_ROWS:
+            return None
+        logging.info(f"Building ANN index over {len(store)} encodings")
+        index = IVFIndex.train(store)
+        with _index_lock:
+            _indexes[index_path(store.encoder_id)] = index
+        index.save(index_path(store.encoder_id))
+        return index
+    added = index.update(store)
+    if added:
+        logging.debug(f"ANN index updated with {added} encodings")
+    return index
+
+def save_index():
+    with _index_lock:
+        indexes = list(_indexes.items())
+    for path, index in indexes:
+        index.save(path)
+
+def find_face(encoding, k=10, nprobe=NPROBE, store=None):
+    """Closest stored faces to an encoding, as [(image_id, face_index, distance)].
+
+    Uses the IVF index when one exists and falls back to exact search otherwise.
+    """
+    if store is None:
+        store = encoding_store.get_store()
+    index = update_index(store)
+    if index is not None:
+        rows, distances = index.search(store, encoding, k * 2, nprobe)
+    else:
+        matrix = np.asarray(store.matrix(), dtype=np.float32)
+        distances = np.linalg.norm(matrix - np.asarray(encoding, dtype=np.float32), axis=1)
+        rows = np.argsort(distances)[:k * 2]
+        distances = distances[rows]
+    owners = encoding_store.get_row_owners(rows.tolist(), store)
+    results = [(*owners[row], float(distance)) for row, distance in zip(rows.tolist(), distances) if row in owners]
+    return results[:k]
@@ -0,0 +1,46 @@
+"""Recall@k and latency of the IVF index against exact search over synthetic face encodings.
+
+Usage: python benchmarks/bench_ann_index.py [rows] [queries]
+"""
+import os, sys, time
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import encoding_store
+import ann_index
+
+K = 10
+
+def synthetic_encodings(rows, identities, rng):
+    # Faces of one identity cluster around a centre, like dlib encodings (norm ~0.5-1.0)
+    centres = rng.normal(0, 0.09, size=(identities, encoding_store.ENCODING_DIM)).astype(np.float32)
+    owners = rng.integers(0, identities, size=rows)
+    return centres[owners] + rng.normal(0, 0.03, size=(rows, encoding_store.ENCODING_DIM)).astype(np.float32)
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = encoding_store.EncodingStore(os.path.join(tmp, "bench_encodings.float32"))
+        for start in range(0, rows, 100000):
+            store.append(synthetic_encodings(min(100000, rows - start), max(1, rows // 20), rng))
+        matrix = np.asarray(store.matrix())
+        query_set = matrix[rng.choice(rows, queries, replace=False)] + rng.normal(0, 0.02, size=(queries, encoding_store.ENCODING_DIM)).astype(np.float32)
+
+        start = time.perf_counter()
+        exact = [np.argsort(np.linalg.norm(matrix - q, axis=1))[:K] for q in query_set]
+        exact_ms = (time.perf_counter() - start) / queries * 1000
+
+        start = time.perf_counter()
+        index = ann_index.IVFIndex.train(store)
+        build = time.perf_counter() - start
+        print(f"{rows} encodings, {queries} queries, nlist={len(index.centroids)}, build {build:.1f}s")
+        print(f"exact search:           {exact_ms:8.2f} ms/query  recall@{K} 1.000")
+        for nprobe in (1, 2, 4, 8, 16, 32, 64):
+            start = time.perf_counter()
+            found = [index.search(store, q, K, nprobe)[0] for q in query_set]
+            ms = (time.perf_counter() - start) / queries * 1000
+            recall = np.mean([len(np.intersect1d(f, e)) / K for f, e in zip(found, exact)])
+            print(f"ivf nprobe={nprobe:<3}         {ms:8.2f} ms/query  recall@{K} {recall:.3f}")
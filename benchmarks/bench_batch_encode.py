@@ -0,0 +1,52 @@
+"""Faces/sec of the embedding step on CPU, one model call per face vs batches of aligned faces.
+
+The faces of the images of a folder are detected and aligned once, then embedded
+at each batch size. Runs the face_recognition (dlib) encoder, and the DeepFace
+VGG-Face encoder with --deepface.
+
+Usage: python benchmarks/bench_batch_encode.py FOLDER [--deepface] [--faces N]
+"""
+import os, sys, time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import image_io
+import encoders
+
+BATCH_SIZES = (1, 8, 16, 32, 64)
+
+def load_faces(folder, encoder, count):
+    import pipeline, deepface_search
+    faces = []
+    for path in image_io.iter_image_files([folder]):
+        buffer, _ = image_io.read_image(path)
+        if encoders.is_deepface(encoder):
+            faces.extend(deepface_search.align(buffer, encoder, 1600)[1])
+        else:
+            faces.extend(pipeline.detect_and_align(buffer, None, 1600)[1])
+        if len(faces) >= count:
+            break
+    return faces[:count]
+
+def bench(faces, encoder, batch_size):
+    import pipeline
+    # Warm up so model loading is not timed
+    pipeline.embed_faces(faces[:batch_size], encoder)
+    start = time.perf_counter()
+    for i in range(0, len(faces), batch_size):
+        pipeline.embed_faces(faces[i:i + batch_size], encoder)
+    return len(faces) / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder")
+    parser.add_argument("--deepface", action="store_true")
+    parser.add_argument("--faces", type=int, default=256)
+    args = parser.parse_args()
+    encoder = encoders.deepface_encoder() if args.deepface else encoders.face_recognition_encoder()
+    faces = load_faces(args.folder, encoder, args.faces)
+    if not faces:
+        sys.exit(f"No face found in {args.folder}")
+    print(f"{encoder.model}: {len(faces)} faces, {os.cpu_count()} CPUs")
+    for batch_size in BATCH_SIZES:
+        print(f"batch {batch_size:3d}: {bench(faces, encoder, batch_size):8.1f} faces/sec")
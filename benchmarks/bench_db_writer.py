@@ -0,0 +1,87 @@
+"""Rows/sec of the queue_images database writes: per-row connect+commit from every worker vs the single DBWriter.
+
+Usage: python benchmarks/bench_db_writer.py [records] [workers]
+"""
+import os, sys, time
+import sqlite3
+import hashlib
+import random
+import tempfile
+from array import array
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import db
+
+def make_record(i):
+    encodings = [array("d", (random.random() for _ in range(128))) for _ in range(random.randint(0, 3))]
+    stat = (random.randint(1 << 20, 1 << 24), time.time_ns(), i, 1)
+    locations = [(10, 60, 60, 10)] * len(encodings)
+    return db.Record(f"/photos/{i // 1000}/IMG_{i}.jpg", hashlib.sha256(str(i).encode()).hexdigest(), len(encodings),
+                     encodings, stat, locations)
+
+def old_style_write(record):
+    # Mirrors the former helpers: a connection and a commit for every statement
+    path, hash_val, num_faces, encodings = record[:4]
+    def run(sql, args, select=None):
+        conn = sqlite3.connect(db.DB_PATH, timeout=10)
+        c = conn.cursor()
+        if select:
+            c.execute(*select)
+            row = c.fetchone()
+            if row:
+                conn.close()
+                return row[0]
+        c.execute(sql, args)
+        conn.commit()
+        rowid = c.lastrowid
+        conn.close()
+        return rowid
+    file_path_id = run("INSERT INTO file_paths (path) VALUES (?)", (path,), ("SELECT id FROM file_paths WHERE path=?", (path,)))
+    image_id = run("INSERT INTO images (hash, num_faces) VALUES (?, ?)", (hash_val, num_faces), ("SELECT id FROM images WHERE hash=?", (hash_val,)))
+    run("INSERT OR IGNORE INTO file_image_map (file_path_id, image_id) VALUES (?, ?)", (file_path_id, image_id))
+    for encoding in encodings:
+        run("INSERT OR IGNORE INTO image_encodings (image_id, encoding) VALUES (?, ?)", (image_id, encoding.tobytes()))
+
+def set_db(path, wal):
+    db.DB_PATH = path
+    if not wal:
+        db.PRAGMAS = ()
+
+def bench_old(records, workers, path):
+    set_db(path, wal=False)
+    # The former helpers ran on the original schema
+    with db.transaction() as conn:
+        db.migrate_v1_base_schema(conn.cursor())
+    db.close_connection()
+    start = time.perf_counter()
+    with Pool(workers, initializer=set_db, initargs=(path, False)) as pool:
+        pool.map(old_style_write, records, chunksize=16)
+    return time.perf_counter() - start
+
+def bench_writer(records, workers, path):
+    set_db(path, wal=True)
+    db.init_db()
+    start = time.perf_counter()
+    writer = db.DBWriter(500, 0.5)
+    writer.start()
+    with Pool(workers) as pool:
+        # Workers hand the records back, like process_image_for_queue does
+        for record in pool.imap(tuple, records, chunksize=16):
+            writer.put(db.Record(*record))
+    writer.close()
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    records = [make_record(i) for i in range(count)]
+    with tempfile.TemporaryDirectory() as tmp:
+        old = bench_old(records, workers, os.path.join(tmp, "old.db"))
+        new = bench_writer(records, workers, os.path.join(tmp, "new.db"))
+        conn = sqlite3.connect(os.path.join(tmp, "new.db"))
+        written = conn.execute("SELECT COUNT(*) FROM file_image_map").fetchone()[0]
+        conn.close()
+    print(f"{count} records, {workers} workers")
+    print(f"per-row connect+commit: {count / old:10.0f} records/sec ({old:.2f}s)")
+    print(f"DBWriter executemany:   {count / new:10.0f} records/sec ({new:.2f}s), {written} mapped")
@@ -0,0 +1,74 @@
+"""Decode + detect time and peak RSS per image at each JPEG draft scale.
+
+Each scale runs in a fresh process so peak RSS is not shared between runs.
+Face detection is timed when the face_recognition package is installed.
+
+Usage: python benchmarks/bench_decode_scale.py [image.jpg] [repeat]
+"""
+import os, sys, time
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import image_io
+
+SCALES = (1, 2, 4, 8)
+
+def peak_rss_mb():
+    # VmHWM belongs to the address space, ru_maxrss on Linux survives exec and would
+    # report the parent's peak in the spawned child
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1024 / 1024
+
+def run_scale(path, scale, repeat):
+    try:
+        import face_recognition
+    except ImportError:
+        face_recognition = None
+    buffer, _ = image_io.read_image(path)
+    baseline = peak_rss_mb()
+    decode = detect = 0.0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with image_io.Image.open(image_io.io.BytesIO(buffer)) as image:
+            max_side = max(image.size) // scale
+        array, _ = image_io.decode_reduced(buffer, max_side if scale > 1 else 0)
+        decode += time.perf_counter() - start
+        if face_recognition:
+            start = time.perf_counter()
+            face_recognition.face_locations(array)
+            detect += time.perf_counter() - start
+    return array.shape[1], array.shape[0], decode / repeat * 1000, detect / repeat * 1000, baseline, peak_rss_mb()
+
+def synthetic_jpeg(path):
+    import numpy as np
+    # 24 megapixels of smooth gradients with noise, close to camera JPEG sizes
+    y, x = np.mgrid[0:4000, 0:6000]
+    base = np.stack([(x / 6000 * 255), (y / 4000 * 255), ((x + y) / 10000 * 255)], axis=2)
+    noise = np.random.default_rng(0).normal(0, 12, base.shape)
+    image_io.Image.fromarray(np.clip(base + noise, 0, 255).astype("uint8")).save(path, quality=92)
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    with tempfile.TemporaryDirectory() as tmp:
+        path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(tmp, "synthetic_24mp.jpg")
+        if not os.path.exists(path):
+            synthetic_jpeg(path)
+        ctx = multiprocessing.get_context("spawn")
+        print(f"{path}, {repeat} runs per scale")
+        print("scale   decoded      decode ms  detect ms  peak RSS MB (baseline)")
+        for scale in SCALES:
+            with ctx.Pool(1) as pool:
+                width, height, decode, detect, baseline, peak = pool.apply(run_scale, (path, scale, repeat))
+            detect_text = f"{detect:9.1f}" if detect else "      n/a"
+            print(f"1/{scale:<5} {width:>5}x{height:<5} {decode:9.1f}  {detect_text}  {peak:8.1f} ({baseline:.1f})")
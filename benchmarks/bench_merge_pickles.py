@@ -0,0 +1,91 @@
+"""Seconds to merge DeepFace representation files: former combine_pickle_files vs representations.merge_pickles.
+
+Synthetic representation files hold records entries of dim values over records / 4
+image files, a fifth of the entries are repeated in another file as the merged
+copies were. Pass --skip-old to only time the new merger.
+
+Usage: python benchmarks/bench_merge_pickles.py [records] [--dim N] [--files N] [--skip-old]
+"""
+import os, sys, time
+import json
+import pickle
+import hashlib
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import representations
+
+def make_files(root, records, dim, files):
+    images = max(1, records // 4)
+    folder = os.path.join(root, "photos")
+    os.makedirs(folder)
+    paths = []
+    for i in range(images):
+        paths.append(os.path.join(folder, f"IMG_{i}.jpg"))
+        open(paths[-1], "wb").close()
+    rng = random.Random(0)
+    unique = records * 4 // 5
+    entries = [{"identity": paths[i % images], "hash": hashlib.sha1(str(i).encode()).hexdigest(),
+                "embedding": [rng.random() for _ in range(dim)],
+                "target_x": i // images * 50, "target_y": 10, "target_w": 40, "target_h": 40}
+               for i in range(unique)]
+    entries += rng.sample(entries, records - unique)
+    rng.shuffle(entries)
+    pickles = os.path.join(root, "merged")
+    os.makedirs(pickles)
+    step = -(-len(entries) // files)
+    for n in range(files):
+        with open(os.path.join(pickles, f"ds_model_vggface_{n}.pkl"), "wb") as f:
+            pickle.dump(entries[n * step:(n + 1) * step], f, protocol=pickle.HIGHEST_PROTOCOL)
+    return pickles
+
+def make_json_safe(obj):
+    if isinstance(obj, dict):
+        return {k: make_json_safe(v) for k, v in sorted(obj.items())}
+    if isinstance(obj, (list, tuple)):
+        return [make_json_safe(v) for v in obj]
+    return obj
+
+def old_combine(directory_path, output_file):
+    # Mirrors the former combine_pickle_files: a walk per entry, then a SHA-256 of canonical JSON per entry
+    combined_rep = []
+    for file_name in os.listdir(directory_path):
+        if file_name.endswith(".pkl"):
+            with open(os.path.join(directory_path, file_name), "rb") as f:
+                combined_rep.extend(pickle.load(f))
+    for item in combined_rep:
+        for r, _, f in os.walk(item["identity"]):
+            for file in f:
+                item["identity"] = os.path.join(r, file)
+    seen, result = set(), []
+    for item in combined_rep:
+        h = hashlib.sha256(json.dumps(make_json_safe(item), sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+        if h not in seen:
+            seen.add(h)
+            result.append(item)
+    with open(output_file, "wb") as out:
+        pickle.dump(result, out, protocol=pickle.HIGHEST_PROTOCOL)
+    return len(result)
+
+def timed(function, *args):
+    start = time.perf_counter()
+    count = function(*args)
+    return time.perf_counter() - start, count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("records", type=int, nargs="?", default=500_000)
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--skip-old", action="store_true")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        pickles = make_files(tmp, args.records, args.dim, args.files)
+        print(f"{args.records} entries of {args.dim} values in {args.files} files")
+        seconds, count = timed(representations.merge_pickles, pickles, os.path.join(tmp, "new.out"), tmp)
+        print(f"merge_pickles:        {seconds:8.1f}s, {count} entries kept")
+        if not args.skip_old:
+            seconds, count = timed(old_combine, pickles, os.path.join(tmp, "old.out"))
+            print(f"combine_pickle_files: {seconds:8.1f}s, {count} entries kept")
@@ -0,0 +1,51 @@
+"""Lookup latency of images by hash at 1M rows, before and after the v2 schema migration.
+
+Usage: python benchmarks/bench_schema_lookup.py [rows] [lookups]
+"""
+import os, sys, time
+import sqlite3
+import hashlib
+import random
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import db
+
+def time_lookups(hashes):
+    c = db.get_connection().cursor()
+    start = time.perf_counter()
+    for hash_val in hashes:
+        c.execute("SELECT id FROM images WHERE hash=?", (hash_val,))
+        c.fetchone()
+    return (time.perf_counter() - start) / len(hashes) * 1000
+
+def time_get_or_create(hashes):
+    start = time.perf_counter()
+    with db.transaction():
+        for hash_val in hashes:
+            db.get_or_create_image(hash_val, 1)
+    return (time.perf_counter() - start) / len(hashes) * 1000
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    hashes = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(rows)]
+    sample = random.sample(hashes, lookups)
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        conn = db.get_connection()
+        with db.transaction():
+            db.migrate_v1_base_schema(conn.cursor())
+            conn.executemany("INSERT INTO images (hash, num_faces) VALUES (?, 1)", ((h,) for h in hashes))
+        before = time_lookups(sample)
+        start = time.perf_counter()
+        db.init_db()
+        migration = time.perf_counter() - start
+        after = time_lookups(sample)
+        upsert = time_get_or_create(sample)
+        db.close_connection()
+    print(f"{rows} images rows, {lookups} random lookups")
+    print(f"v1 (no index) SELECT by hash:   {before:8.3f} ms/lookup")
+    print(f"migration to v2:                {migration:8.2f} s")
+    print(f"v2 (unique index) SELECT:       {after:8.3f} ms/lookup")
+    print(f"v2 get_or_create_image UPSERT:  {upsert:8.3f} ms/call")
@@ -0,0 +1,28 @@
+import threading
+
+class Cancelled(Exception):
+    """Raised by CancelToken.check once the operation is cancelled."""
+
+class CancelToken:
+    """Cancellation of one operation, shared by all its stages and threads.
+
+    cancel() may be called from any thread. Loops test cancelled or call check()
+    between units of work, blocking waits use short timeouts so that every stage
+    notices within a fraction of a second. A token made with a parent is also
+    cancelled by it, a stage can stop its own helpers without stopping the others.
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set() or (self.parent is not None and self.parent.cancelled)
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled()
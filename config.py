@@ -6,17 +6,15 @@ import configparser
 import utils
 
 def initialize(): 
-    global INSTALL_DIR,LOG_FILE,LOG_LEVEL,LOG_BACKUP_COUNT,OUTPUT,WORKERS,QUEUE_FILE,CONFIG_FILE,configfile,processed_count,matches_found,total_images,processed_files,stop_flag
+    global INSTALL_DIR,LOG_FILE,LOG_LEVEL,LOG_BACKUP_COUNT,OUTPUT,WORKERS,CONFIG_FILE,configfile,processed_count,matches_found,total_images,processed_files,DB_BATCH_SIZE,DB_FLUSH_MS,ENCODING_DTYPE,TOLERANCE,PARANOID_RESCAN,READ_THREADS,MAX_DETECTION_SIDE,ENCODING_MODEL,ENCODING_JITTERS,STORE_LANDMARKS,ENCODE_BATCH_SIZE,WORKER_MAX_RSS_MB,PRELOAD_DEEPFACE,NEAR_DUPLICATE_DISTANCE,THUMBNAIL_CACHE_MB,JOB_LEASE_SECONDS,JOB_MAX_ATTEMPTS
     INSTALL_DIR=utils.get_main_dir()  
     LOG_LEVEL=logging.INFO
     CONFIG_FILE = os.path.join(INSTALL_DIR,"config.ini")
     configfile = configparser.ConfigParser()
  
     LOG_FILE = os.path.join(INSTALL_DIR,"logs", "FaceRecognition.log")
-    QUEUE_FILE = os.path.join(INSTALL_DIR,"image_queue.txt")
     LOG_BACKUP_COUNT = 10  # Keep up to 10 backup logs
 
-    stop_flag=False
     processed_count=0
     processed_files=[]
     total_images=0
@@ -26,6 +24,23 @@ def initialize():
     WORKERS=int(configfile["Settings"]["workers"])
     OUTPUT=configfile["Settings"]["output_folder"]
     LOG_LEVEL=int(configfile["Settings"]["log_level"]) 
+    DB_BATCH_SIZE=configfile.getint("Settings", "db_batch_size", fallback=500)
+    DB_FLUSH_MS=configfile.getint("Settings", "db_flush_ms", fallback=500)
+    ENCODING_DTYPE=configfile.get("Settings", "encoding_dtype", fallback="float32")
+    TOLERANCE=configfile.getfloat("Settings", "tolerance", fallback=0.5)
+    PARANOID_RESCAN=configfile.getboolean("Settings", "paranoid_rescan", fallback=False)
+    READ_THREADS=configfile.getint("Settings", "read_threads", fallback=4)
+    MAX_DETECTION_SIDE=configfile.getint("Settings", "max_detection_side", fallback=1600)
+    ENCODING_MODEL=configfile.get("Settings", "encoding_model", fallback="small")
+    ENCODING_JITTERS=configfile.getint("Settings", "encoding_jitters", fallback=1)
+    STORE_LANDMARKS=configfile.getboolean("Settings", "store_landmarks", fallback=False)
+    ENCODE_BATCH_SIZE=configfile.getint("Settings", "encode_batch_size", fallback=16)
+    WORKER_MAX_RSS_MB=configfile.getint("Settings", "worker_max_rss_mb", fallback=2048)
+    PRELOAD_DEEPFACE=configfile.getboolean("Settings", "preload_deepface", fallback=False)
+    NEAR_DUPLICATE_DISTANCE=configfile.getint("Settings", "near_duplicate_distance", fallback=4)
+    THUMBNAIL_CACHE_MB=configfile.getint("Settings", "thumbnail_cache_mb", fallback=64)
+    JOB_LEASE_SECONDS=configfile.getint("Settings", "job_lease_seconds", fallback=60)
+    JOB_MAX_ATTEMPTS=configfile.getint("Settings", "job_max_attempts", fallback=3)
    
 def load_config():
     """Load configuration from INI file."""
@@ -44,7 +59,24 @@ def load_config():
             "root_folder": "",
             "output_folder": OUTPUT,
             "workers": WORKERS,         #default to number of CPU
-            "log_level": logging.INFO # https://docs.python.org/3/library/logging.html#logging-leve ls
+            "log_level": logging.INFO, # https://docs.python.org/3/library/logging.html#logging-leve ls
+            "db_batch_size": 500,       # records per executemany flush of the DB writer
+            "db_flush_ms": 500,         # max delay before pending records are flushed
+            "encoding_dtype": "float32", # float32 or float16 face encoding matrix on disk, for new encoders
+            "tolerance": 0.5,           # max face distance for a match, lower is stricter
+            "paranoid_rescan": False,   # re-hash every file even when size/mtime/inode are unchanged
+            "read_threads": 4,          # I/O threads reading files ahead of the encoding workers
+            "max_detection_side": 1600, # decode images down to about this size for face detection, 0 for full size
+            "encoding_model": "small",  # landmark model used to align faces before encoding, small or large
+            "encoding_jitters": 1,      # times each face is resampled when encoding, higher is slower and more accurate
+            "store_landmarks": False,   # also store the face landmarks with the detection boxes
+            "encode_batch_size": 16,    # aligned faces embedded per call of the embedding model
+            "worker_max_rss_mb": 2048,  # the worker pool is restarted between operations when a worker exceeds this, 0 never
+            "preload_deepface": False,  # load the DeepFace model in every worker when the pool starts
+            "near_duplicate_distance": 4, # max perceptual hash bits apart for a copy to reuse the face boxes of an encoded image, -1 never
+            "thumbnail_cache_mb": 64,   # memory used by the thumbnails shown in the window, they are also kept on disk
+            "job_lease_seconds": 60,    # seconds after which the files held by a crashed scan are taken over
+            "job_max_attempts": 3       # tries of a failing file before the scans leave it out
         }
         save_config()
         load_config()# Load config at module import
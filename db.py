@@ -0,0 +1,1001 @@
+import os
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from queue import Queue, Empty
+from contextlib import contextmanager
+
+DB_PATH = "face_recognition.db"
+
+# Applied to every connection. WAL lets readers run while one writer commits,
+# NORMAL sync only fsyncs at checkpoints instead of at every commit.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=10000",
+)
+
+_local = threading.local()
+
+# Encoder of the encodings stored before encoders were recorded
+LEGACY_ENCODER_ID = 1
+
+# Unit of work of the DBWriter. encodings is None when the image is already encoded,
+# stat is (size, mtime_ns, inode, device) and locations the (top, right, bottom, left)
+# face boxes in original image coordinates, with their landmarks when they were computed.
+# signature is the (perceptual hash, (width, height)) of image_io.perceptual_hash.
+# derived is set when the boxes were taken from a near duplicate, see derived_detector.
+Record = namedtuple("Record", "path hash num_faces encodings stat locations landmarks signature derived",
+                    defaults=(None, None, None, None, False))
+
+def derived_detector(detector):
+    """Detector tag of face boxes taken from a near duplicate: the detector itself has not run on the image."""
+    return f"{detector}+near_dup"
+
+def connect(db_path=None):
+    """Open a new connection with the application pragmas applied."""
+    conn = sqlite3.connect(db_path or DB_PATH, timeout=10)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def get_connection():
+    """Return the connection owned by this process/thread, opening it on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "pid", None) != os.getpid():
+        # A forked child inherits the parent's thread local, never reuse that handle
+        conn = connect()
+        _local.conn = conn
+        _local.pid = os.getpid()
+        _local.depth = 0
+    return conn
+
+def close_connection():
+    conn = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "pid", None) == os.getpid():
+        try:
+            conn.close()
+        except Exception as e:
+            logging.warning(f"Error closing database connection: {e}")
+    _local.conn = None
+
+def init_worker():
+    """Pool initializer: open the connection once per worker process."""
+    get_connection()
+
+@contextmanager
+def transaction():
+    """Group writes into a single transaction, nested calls join the outer one."""
+    conn = get_connection()
+    depth = getattr(_local, "depth", 0)
+    if depth == 0 and not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    _local.depth = depth + 1
+    try:
+        yield conn
+        if depth == 0:
+            conn.commit()
+    except Exception:
+        if depth == 0:
+            conn.rollback()
+        raise
+    finally:
+        _local.depth = depth
+
+def migrate_v1_base_schema(c):
+    # Table for file paths (can have same hash in different locations)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS file_paths (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT UNIQUE
+        )
+    """)
+    # Table for images (hash and metadata, not tied to path)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            hash TEXT,
+            num_faces INTEGER
+        )
+    """)
+    # Table for mapping file path to image hash
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS file_image_map (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_path_id INTEGER,
+            image_id INTEGER,
+            FOREIGN KEY(file_path_id) REFERENCES file_paths(id),
+            FOREIGN KEY(image_id) REFERENCES images(id),
+            UNIQUE(file_path_id, image_id)
+        )
+    """)
+    # Table for matches (now with person_id instead of encoding)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS matches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_id INTEGER,
+            person_id INTEGER,
+            FOREIGN KEY(image_id) REFERENCES images(id),
+            FOREIGN KEY(person_id) REFERENCES persons(id)
+        )
+    """)
+    # Table for persons
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS persons (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE
+        )
+    """)
+    # Table for known images (used for known encodings)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS known_images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            person_id INTEGER,
+            image_id INTEGER,
+            FOREIGN KEY(person_id) REFERENCES persons(id),
+            FOREIGN KEY(image_id) REFERENCES images(id)
+        )
+    """)
+    # Table for all encodings per image
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS image_encodings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_id INTEGER,
+            encoding BLOB,
+            UNIQUE(image_id, encoding),
+            FOREIGN KEY(image_id) REFERENCES images(id)
+        )
+    """)
+
+def migrate_v2_indexes(c):
+    # Merge images sharing a hash into the oldest row, then make the hash unique
+    c.execute("""
+        CREATE TEMP TABLE image_dups AS
+        SELECT images.id AS dup_id, keep.keep_id
+        FROM images
+        JOIN (SELECT hash, MIN(id) AS keep_id FROM images GROUP BY hash HAVING COUNT(*) > 1) keep
+            ON images.hash = keep.hash AND images.id <> keep.keep_id
+    """)
+    for table in ("file_image_map", "matches", "known_images", "image_encodings"):
+        c.execute(f"""
+            UPDATE OR IGNORE {table}
+            SET image_id = (SELECT keep_id FROM image_dups WHERE dup_id = {table}.image_id)
+            WHERE image_id IN (SELECT dup_id FROM image_dups)
+        """)
+        c.execute(f"DELETE FROM {table} WHERE image_id IN (SELECT dup_id FROM image_dups)")
+    c.execute("DELETE FROM images WHERE id IN (SELECT dup_id FROM image_dups)")
+    c.execute("DROP TABLE image_dups")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_images_hash ON images(hash)")
+
+    c.execute("DELETE FROM matches WHERE id NOT IN (SELECT MIN(id) FROM matches GROUP BY image_id, person_id)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_matches_image_person ON matches(image_id, person_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_matches_person ON matches(person_id)")
+
+    c.execute("DELETE FROM known_images WHERE id NOT IN (SELECT MIN(id) FROM known_images GROUP BY person_id, image_id)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_known_images_person_image ON known_images(person_id, image_id)")
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_file_image_map_image ON file_image_map(image_id)")
+
+    # Encodings are identified by their position in the image, not by comparing whole blobs
+    c.execute("""
+        CREATE TABLE image_encodings_v2 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_id INTEGER,
+            face_index INTEGER,
+            encoding BLOB,
+            UNIQUE(image_id, face_index),
+            FOREIGN KEY(image_id) REFERENCES images(id)
+        )
+    """)
+    c.execute("""
+        INSERT INTO image_encodings_v2 (id, image_id, face_index, encoding)
+        SELECT id, image_id, ROW_NUMBER() OVER (PARTITION BY image_id ORDER BY id) - 1, encoding
+        FROM image_encodings
+        WHERE id IN (SELECT MIN(id) FROM image_encodings GROUP BY image_id, encoding)
+    """)
+    c.execute("DROP TABLE image_encodings")
+    c.execute("ALTER TABLE image_encodings_v2 RENAME TO image_encodings")
+
+def migrate_v3_encoding_store(c):
+    # Encodings move to the memory-mapped matrix of encoding_store, only the row stays here
+    import encoding_store
+    c.execute("ALTER TABLE image_encodings ADD COLUMN store_row INTEGER")
+    # These encodings become the ones of the first encoder registered by migrate_v8_encoders
+    store = encoding_store.get_store(LEGACY_ENCODER_ID, encoding_store.configured_dtype(), dim=encoding_store.ENCODING_DIM)
+    encoding_store.migrate_blobs(c, store)
+
+def migrate_v4_match_scores(c):
+    # Best distance per (image, face, person) so a new tolerance is a query, not a rescan
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS match_scores (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_id INTEGER,
+            face_index INTEGER,
+            person_id INTEGER,
+            distance REAL,
+            UNIQUE(image_id, face_index, person_id),
+            FOREIGN KEY(image_id) REFERENCES images(id),
+            FOREIGN KEY(person_id) REFERENCES persons(id)
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_match_scores_person_distance ON match_scores(person_id, distance)")
+    c.execute("ALTER TABLE matches ADD COLUMN distance REAL")
+
+def migrate_v5_store_row_index(c):
+    # Nearest neighbour search returns store rows, they are resolved back to images through this index
+    c.execute("CREATE INDEX IF NOT EXISTS idx_image_encodings_store_row ON image_encodings(store_row)")
+
+def migrate_v6_file_stat(c):
+    # Last seen hash and stat of each path, a rescan trusts the hash while the stat is unchanged
+    for column in ("hash TEXT", "size INTEGER", "mtime_ns INTEGER", "inode INTEGER", "device INTEGER"):
+        c.execute(f"ALTER TABLE file_paths ADD COLUMN {column}")
+    c.execute("""
+        UPDATE file_paths SET hash = (
+            SELECT images.hash FROM file_image_map
+            JOIN images ON images.id = file_image_map.image_id
+            WHERE file_image_map.file_path_id = file_paths.id
+            ORDER BY file_image_map.id DESC LIMIT 1
+        )
+    """)
+
+def migrate_v7_faces(c):
+    # Detection boxes per face, re-encoding crops from them instead of detecting again
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS faces (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_id INTEGER,
+            face_index INTEGER,
+            top INTEGER,
+            right INTEGER,
+            bottom INTEGER,
+            left INTEGER,
+            landmarks TEXT,
+            UNIQUE(image_id, face_index),
+            FOREIGN KEY(image_id) REFERENCES images(id)
+        )
+    """)
+
+def migrate_v8_encoders(c):
+    # Encodings are cached per (image, encoder), the encoder key says what produced them
+    import encoders, encoding_store, ann_index
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS encoders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            model TEXT,
+            detector TEXT,
+            alignment TEXT,
+            normalization TEXT,
+            dim INTEGER,
+            UNIQUE(model, detector, alignment, normalization)
+        )
+    """)
+    # Everything encoded so far used the default face_recognition settings
+    c.execute("INSERT INTO encoders (id, model, detector, alignment, normalization, dim) VALUES (?, ?, ?, ?, ?, ?)",
+              (LEGACY_ENCODER_ID, *encoders.face_recognition_encoder()))
+    c.execute("""
+        CREATE TABLE image_encodings_v8 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_id INTEGER,
+            encoder_id INTEGER,
+            face_index INTEGER,
+            store_row INTEGER,
+            UNIQUE(encoder_id, image_id, face_index),
+            FOREIGN KEY(image_id) REFERENCES images(id),
+            FOREIGN KEY(encoder_id) REFERENCES encoders(id)
+        )
+    """)
+    c.execute("""
+        INSERT INTO image_encodings_v8 (id, image_id, encoder_id, face_index, store_row)
+        SELECT id, image_id, ?, face_index, store_row FROM image_encodings WHERE store_row IS NOT NULL
+    """, (LEGACY_ENCODER_ID,))
+    c.execute("DROP TABLE image_encodings")
+    c.execute("ALTER TABLE image_encodings_v8 RENAME TO image_encodings")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_image_encodings_store_row ON image_encodings(encoder_id, store_row)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_image_encodings_image ON image_encodings(image_id)")
+    # One row per image and encoder that has run on it, also for images without any face
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS image_encoders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_id INTEGER,
+            encoder_id INTEGER,
+            num_faces INTEGER,
+            UNIQUE(image_id, encoder_id),
+            FOREIGN KEY(image_id) REFERENCES images(id),
+            FOREIGN KEY(encoder_id) REFERENCES encoders(id)
+        )
+    """)
+    c.execute("""
+        INSERT INTO image_encoders (image_id, encoder_id, num_faces)
+        SELECT id, ?, num_faces FROM images
+        WHERE num_faces = 0 OR id IN (SELECT image_id FROM image_encodings)
+    """, (LEGACY_ENCODER_ID,))
+    # Boxes depend on the detector only, every encoder using that detector crops from them
+    c.execute("""
+        CREATE TABLE faces_v8 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_id INTEGER,
+            detector TEXT,
+            face_index INTEGER,
+            top INTEGER,
+            right INTEGER,
+            bottom INTEGER,
+            left INTEGER,
+            landmarks TEXT,
+            UNIQUE(image_id, detector, face_index),
+            FOREIGN KEY(image_id) REFERENCES images(id)
+        )
+    """)
+    c.execute("""
+        INSERT INTO faces_v8 (id, image_id, detector, face_index, top, right, bottom, left, landmarks)
+        SELECT id, image_id, ?, face_index, top, right, bottom, left, landmarks FROM faces
+    """, (encoders.FACE_RECOGNITION_DETECTOR,))
+    c.execute("DROP TABLE faces")
+    c.execute("ALTER TABLE faces_v8 RENAME TO faces")
+    # Files of the former single store and index now belong to the first encoder
+    base = os.path.splitext(DB_PATH)[0]
+    for dtype in encoding_store.DTYPES:
+        if os.path.exists(f"{base}_encodings.{dtype}"):
+            os.replace(f"{base}_encodings.{dtype}", encoding_store.store_path(dtype, LEGACY_ENCODER_ID))
+    if os.path.exists(f"{base}_ivf.npz"):
+        os.replace(f"{base}_ivf.npz", ann_index.index_path(LEGACY_ENCODER_ID))
+
+def migrate_v9_perceptual_hash(c):
+    # Perceptual hash and size of each image, near duplicates reuse the face boxes of an encoded copy
+    for column in ("phash INTEGER", "width INTEGER", "height INTEGER"):
+        c.execute(f"ALTER TABLE images ADD COLUMN {column}")
+
+def migrate_v10_imported_files(c):
+    # External files already imported (DeepFace representation pickles), with their stat when imported
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS imported_files (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime_ns INTEGER
+        )
+    """)
+
+def migrate_v11_jobs(c):
+    # Durable work queues of the scans (jobs.JobQueue), one row per file of a queue and,
+    # while the files are being listed, a 'listing' row with an empty path leased by the lister
+    # (a 'complete' row once a scan ended, see mark_jobs_complete)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            queue TEXT NOT NULL,
+            path TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            lease_owner TEXT,
+            lease_expires REAL,
+            UNIQUE(queue, path)
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_queue_state ON jobs(queue, state)")
+
+def migrate_v12_encoder_dtype(c):
+    # dtype of each encoder's store file, the store rows of image_encodings point into that file
+    import encoding_store
+    c.execute("ALTER TABLE encoders ADD COLUMN dtype TEXT")
+    configured = encoding_store.configured_dtype()
+    for (encoder_id,) in c.execute("SELECT id FROM encoders").fetchall():
+        dtypes = [dtype for dtype in encoding_store.DTYPES if encoding_store.has_rows(dtype, encoder_id)]
+        if not dtypes:
+            continue
+        dtype = configured if configured in dtypes else dtypes[0]
+        if len(dtypes) > 1:
+            logging.warning(f"Encoder {encoder_id} has encodings in several dtypes, keeping {dtype}. "
+                            f"Rows written before encoding_dtype changed may point to the wrong faces")
+        c.execute("UPDATE encoders SET dtype=? WHERE id=?", (dtype, encoder_id))
+
+def migrate_v13_detections(c):
+    # One row per image and detector that has run on it, also for images without any face
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS detections (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_id INTEGER,
+            detector TEXT,
+            num_faces INTEGER,
+            UNIQUE(image_id, detector),
+            FOREIGN KEY(image_id) REFERENCES images(id)
+        )
+    """)
+    c.execute("""
+        INSERT INTO detections (image_id, detector, num_faces)
+        SELECT image_id, detector, COUNT(*) FROM faces GROUP BY image_id, detector
+    """)
+    # An encoder that found no face in an image ran its detector on it
+    c.execute("""
+        INSERT INTO detections (image_id, detector, num_faces)
+        SELECT image_encoders.image_id, encoders.detector, 0 FROM image_encoders
+        JOIN encoders ON encoders.id = image_encoders.encoder_id WHERE image_encoders.num_faces = 0
+        ON CONFLICT(image_id, detector) DO NOTHING
+    """)
+
+# Ordered (version, migration) pairs, the applied version is kept in PRAGMA user_version
+MIGRATIONS = (
+    (1, migrate_v1_base_schema),
+    (2, migrate_v2_indexes),
+    (3, migrate_v3_encoding_store),
+    (4, migrate_v4_match_scores),
+    (5, migrate_v5_store_row_index),
+    (6, migrate_v6_file_stat),
+    (7, migrate_v7_faces),
+    (8, migrate_v8_encoders),
+    (9, migrate_v9_perceptual_hash),
+    (10, migrate_v10_imported_files),
+    (11, migrate_v11_jobs),
+    (12, migrate_v12_encoder_dtype),
+    (13, migrate_v13_detections),
+)
+
+def init_db():
+    try:
+        conn = get_connection()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for target, migrate in MIGRATIONS:
+            if target <= version:
+                continue
+            logging.info(f"Migrating database schema from version {version} to {target}")
+            with transaction():
+                migrate(conn.cursor())
+                conn.execute(f"PRAGMA user_version={target}")
+            version = target
+    except Exception as e:
+        logging.error(f"SQLite error in init_db: {e}")
+
+# The helpers below use the shared connection and do not commit on their own,
+# callers wrap the writes for one image in transaction().
+
+def get_or_create_image(hash_val, num_faces):
+    c = get_connection().cursor()
+    c.execute(
+        "INSERT INTO images (hash, num_faces) VALUES (?, ?) "
+        "ON CONFLICT(hash) DO UPDATE SET hash=excluded.hash RETURNING id", (hash_val, num_faces))
+    return c.fetchone()[0]
+
+def get_or_create_encoder(encoder):
+    """Id of an encoders.Encoder, inserted on first use."""
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO encoders (model, detector, alignment, normalization, dim) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(model, detector, alignment, normalization) DO UPDATE SET dim=excluded.dim RETURNING id",
+            tuple(encoder))
+        return c.fetchone()[0]
+
+def get_encoder_dim(encoder_id):
+    c = get_connection().cursor()
+    c.execute("SELECT dim FROM encoders WHERE id=?", (encoder_id,))
+    row = c.fetchone()
+    return row[0] if row else None
+
+def get_encoder_dtype(encoder_id):
+    c = get_connection().cursor()
+    c.execute("SELECT dtype FROM encoders WHERE id=?", (encoder_id,))
+    row = c.fetchone()
+    return row[0] if row else None
+
+def set_encoder_dtype(encoder_id, dtype):
+    get_connection().execute("UPDATE encoders SET dtype=? WHERE id=?", (dtype, encoder_id))
+
+def get_file_state(path, encoder_id):
+    """(size, mtime_ns, inode, device, hash, num_faces) recorded for a path at the last scan, or None.
+
+    num_faces is None when the content was not encoded by the encoder yet.
+    """
+    c = get_connection().cursor()
+    c.execute(
+        "SELECT file_paths.size, file_paths.mtime_ns, file_paths.inode, file_paths.device, file_paths.hash, image_encoders.num_faces "
+        "FROM file_paths JOIN images ON images.hash = file_paths.hash "
+        "LEFT JOIN image_encoders ON image_encoders.image_id = images.id AND image_encoders.encoder_id=? "
+        "WHERE file_paths.path=?", (encoder_id, path))
+    return c.fetchone()
+
+def get_path_state(path):
+    """(size, mtime_ns, inode, device, hash) recorded for a path at the last scan, or None."""
+    c = get_connection().cursor()
+    c.execute("SELECT size, mtime_ns, inode, device, hash FROM file_paths WHERE path=?", (path,))
+    return c.fetchone()
+
+def get_num_faces(hash_val, encoder_id):
+    """Faces the encoder found in an image content, None when it has not encoded it."""
+    c = get_connection().cursor()
+    c.execute(
+        "SELECT image_encoders.num_faces FROM images JOIN image_encoders ON image_encoders.image_id = images.id "
+        "WHERE images.hash=? AND image_encoders.encoder_id=?", (hash_val, encoder_id))
+    row = c.fetchone()
+    return row[0] if row else None
+
+def get_face_locations(hash_val, detector):
+    """Stored (top, right, bottom, left) boxes of an image content, [] when the detector found no face
+    and None when it was never detected."""
+    c = get_connection().cursor()
+    c.execute(
+        "SELECT detections.num_faces FROM detections JOIN images ON images.id = detections.image_id "
+        "WHERE images.hash=? AND detections.detector=?", (hash_val, detector))
+    row = c.fetchone()
+    if row is None:
+        return None
+    if row[0] == 0:
+        return []
+    c.execute(
+        "SELECT faces.top, faces.right, faces.bottom, faces.left FROM faces JOIN images ON images.id = faces.image_id "
+        "WHERE images.hash=? AND faces.detector=? ORDER BY faces.face_index", (hash_val, detector))
+    return c.fetchall()
+
+def iter_perceptual_hashes(chunk=10000):
+    """Yield (hash, phash, width, height) of every image with a perceptual hash."""
+    c = get_connection().cursor()
+    c.execute("SELECT hash, phash, width, height FROM images WHERE phash IS NOT NULL")
+    while True:
+        rows = c.fetchmany(chunk)
+        if not rows:
+            break
+        yield from rows
+
+def is_imported(path, size, mtime_ns):
+    c = get_connection().cursor()
+    c.execute("SELECT 1 FROM imported_files WHERE path=? AND size=? AND mtime_ns=?", (path, size, mtime_ns))
+    return c.fetchone() is not None
+
+def mark_imported(path, size, mtime_ns):
+    get_connection().execute(
+        "INSERT INTO imported_files (path, size, mtime_ns) VALUES (?, ?, ?) "
+        "ON CONFLICT(path) DO UPDATE SET size=excluded.size, mtime_ns=excluded.mtime_ns", (path, size, mtime_ns))
+
+def add_jobs(queue, paths):
+    get_connection().executemany(
+        "INSERT INTO jobs (queue, path) VALUES (?, ?) ON CONFLICT(queue, path) DO NOTHING",
+        [(queue, path) for path in paths])
+
+def lease_jobs(queue, owner, limit, now, expires):
+    """Lease up to limit pending jobs, or jobs whose lease expired, to owner. Returns their paths."""
+    c = get_connection().cursor()
+    c.execute("""
+        UPDATE jobs SET state='leased', lease_owner=?, lease_expires=?, attempts=attempts+1
+        WHERE id IN (
+            SELECT id FROM jobs WHERE queue=? AND (state='pending' OR (state='leased' AND lease_expires<?))
+            ORDER BY id LIMIT ?)
+        RETURNING path
+    """, (owner, expires, queue, now, limit))
+    return [row[0] for row in c.fetchall()]
+
+def renew_jobs(queue, owner, expires):
+    get_connection().execute(
+        "UPDATE jobs SET lease_expires=? WHERE queue=? AND lease_owner=? AND state IN ('leased', 'listing')",
+        (expires, queue, owner))
+
+def get_job_listing(queue):
+    """(owner, lease expiry) of the run listing the files of a queue, None when it is listed."""
+    c = get_connection().cursor()
+    c.execute("SELECT lease_owner, lease_expires FROM jobs WHERE queue=? AND state='listing'", (queue,))
+    return c.fetchone()
+
+def start_job_listing(queue, owner, expires):
+    get_connection().execute(
+        "INSERT INTO jobs (queue, path, state, lease_owner, lease_expires) VALUES (?, '', 'listing', ?, ?)",
+        (queue, owner, expires))
+
+def mark_jobs_complete(queue):
+    """Record that a scan of the queue ended, its next scan lists the files again instead of resuming."""
+    get_connection().execute(
+        "INSERT INTO jobs (queue, path, state) VALUES (?, '', 'complete') ON CONFLICT(queue, path) DO NOTHING", (queue,))
+
+def reset_jobs(queue):
+    """Keep only the jobs still to do: done and failed jobs and the control row are removed before a new listing."""
+    get_connection().execute("DELETE FROM jobs WHERE queue=? AND state NOT IN ('pending', 'leased')", (queue,))
+
+def end_job_listing(queue, owner):
+    """Remove the listing row of owner, returns False when it had none."""
+    c = get_connection().cursor()
+    c.execute("DELETE FROM jobs WHERE queue=? AND state='listing' AND lease_owner=?", (queue, owner))
+    return c.rowcount > 0
+
+def complete_jobs(queue, owner, paths):
+    get_connection().executemany(
+        "UPDATE jobs SET state='done', lease_owner=NULL, lease_expires=NULL "
+        "WHERE queue=? AND path=? AND lease_owner=? AND state='leased'", [(queue, path, owner) for path in paths])
+
+def fail_jobs(queue, owner, paths, error, max_attempts):
+    """Put leased jobs back to pending for a retry, or to failed after max_attempts leases."""
+    get_connection().executemany(
+        "UPDATE jobs SET state=CASE WHEN attempts>=? THEN 'failed' ELSE 'pending' END, last_error=?, "
+        "lease_owner=NULL, lease_expires=NULL WHERE queue=? AND path=? AND lease_owner=? AND state='leased'",
+        [(max_attempts, error, queue, path, owner) for path in paths])
+
+def release_jobs(queue, owner):
+    """Put the jobs still leased by owner back to pending, without counting the attempt."""
+    get_connection().execute(
+        "UPDATE jobs SET state='pending', attempts=MAX(attempts-1, 0), lease_owner=NULL, lease_expires=NULL "
+        "WHERE queue=? AND lease_owner=? AND state='leased'", (queue, owner))
+
+def get_leased_jobs(queue, owner):
+    c = get_connection().cursor()
+    c.execute("SELECT path FROM jobs WHERE queue=? AND lease_owner=? AND state='leased'", (queue, owner))
+    return [row[0] for row in c.fetchall()]
+
+def count_jobs(queue):
+    """{state: number of jobs} of a queue."""
+    c = get_connection().cursor()
+    c.execute("SELECT state, COUNT(*) FROM jobs WHERE queue=? GROUP BY state", (queue,))
+    return dict(c.fetchall())
+
+def get_failed_jobs(queue, limit=10):
+    c = get_connection().cursor()
+    c.execute("SELECT path, attempts, last_error FROM jobs WHERE queue=? AND state='failed' ORDER BY id LIMIT ?",
+              (queue, limit))
+    return c.fetchall()
+
+def next_lease_expiry(queue, owner):
+    """Earliest expiry of the leases (jobs or listing) of other owners, None when there are none."""
+    c = get_connection().cursor()
+    c.execute("SELECT MIN(lease_expires) FROM jobs WHERE queue=? AND state IN ('leased', 'listing') AND lease_owner<>?",
+              (queue, owner))
+    return c.fetchone()[0]
+
+def delete_jobs(queue):
+    get_connection().execute("DELETE FROM jobs WHERE queue=?", (queue,))
+
+def get_image_ids_for_paths(paths):
+    """Map each indexed path to its image_id."""
+    paths = list(paths)
+    image_ids = {}
+    c = get_connection().cursor()
+    for i in range(0, len(paths), 500):
+        chunk = paths[i:i + 500]
+        c.execute(
+            "SELECT file_paths.path, file_image_map.image_id FROM file_paths "
+            "JOIN file_image_map ON file_image_map.file_path_id = file_paths.id "
+            f"WHERE file_paths.path IN ({','.join('?' * len(chunk))})", chunk)
+        image_ids.update(c.fetchall())
+    return image_ids
+
+def insert_image_encoding(image_id, face_index, encoding, encoder_id=None):
+    import encoding_store
+    store = encoding_store.get_store(encoder_id)
+    c = get_connection().cursor()
+    c.execute("SELECT id FROM image_encodings WHERE encoder_id=? AND image_id=? AND face_index=?",
+              (store.encoder_id, image_id, face_index))
+    if c.fetchone():
+        return
+    store_row = store.append(encoding)
+    c.execute("INSERT INTO image_encodings (image_id, encoder_id, face_index, store_row) VALUES (?, ?, ?, ?)",
+              (image_id, store.encoder_id, face_index, store_row))
+
+def mark_encoded(image_id, encoder_id, num_faces):
+    """Record that an encoder has run on an image, so it is not encoded again."""
+    get_connection().execute(
+        "INSERT INTO image_encoders (image_id, encoder_id, num_faces) VALUES (?, ?, ?) "
+        "ON CONFLICT(image_id, encoder_id) DO NOTHING", (image_id, encoder_id, num_faces))
+
+def face_rows(locations, landmarks=None):
+    """(face_index, top, right, bottom, left, landmarks) rows of the boxes of one image, landmarks as JSON."""
+    landmarks = landmarks or [None] * len(locations)
+    return [(face_index, *map(int, location), json.dumps(points) if points else None)
+            for face_index, (location, points) in enumerate(zip(locations, landmarks))]
+
+def insert_faces(image_id, detector, locations, landmarks=None):
+    """Store the (top, right, bottom, left) boxes found by a detector, landmarks are dicts of points or None."""
+    get_connection().execute(
+        "INSERT INTO detections (image_id, detector, num_faces) VALUES (?, ?, ?) "
+        "ON CONFLICT(image_id, detector) DO NOTHING", (image_id, detector, len(locations)))
+    get_connection().executemany(
+        "INSERT INTO faces (image_id, detector, face_index, top, right, bottom, left, landmarks) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(image_id, detector, face_index) DO NOTHING",
+        [(image_id, detector, *row) for row in face_rows(locations, landmarks)])
+
+def iter_face_locations(detector, encoder_id, chunk=500):
+    """Yield lists of (image_id, hash, path, locations) for the images the detector has run on
+    that the encoder has not encoded yet, locations is empty for images without any face."""
+    c = get_connection().cursor()
+    last_id = -1
+    while True:
+        c.execute("""
+            SELECT detections.image_id, images.hash, detections.num_faces
+            FROM detections JOIN images ON images.id = detections.image_id
+            WHERE detections.detector=? AND detections.image_id > ? AND NOT EXISTS (
+                SELECT 1 FROM image_encoders
+                WHERE image_encoders.image_id = detections.image_id AND image_encoders.encoder_id=?)
+            ORDER BY detections.image_id LIMIT ?
+        """, (detector, last_id, encoder_id, chunk))
+        rows = c.fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        images = {image_id: (hash_val, []) for image_id, hash_val, _ in rows}
+        with_faces = [image_id for image_id, _, num_faces in rows if num_faces]
+        if with_faces:
+            c.execute(
+                "SELECT image_id, top, right, bottom, left FROM faces "
+                f"WHERE detector=? AND image_id IN ({','.join('?' * len(with_faces))}) ORDER BY image_id, face_index",
+                (detector, *with_faces))
+            for image_id, *location in c.fetchall():
+                images[image_id][1].append(tuple(location))
+        paths = get_paths_for_image_ids(images.keys())
+        yield [(image_id, hash_val, paths[image_id], locations)
+               for image_id, (hash_val, locations) in images.items() if image_id in paths]
+
+def insert_match(image_id, person_id, distance=None):
+    # Ensure only one match per image/person, keeping the best distance
+    get_connection().execute(
+        "INSERT INTO matches (image_id, person_id, distance) VALUES (?, ?, ?) "
+        "ON CONFLICT(image_id, person_id) DO UPDATE "
+        "SET distance=MIN(COALESCE(distance, excluded.distance), COALESCE(excluded.distance, distance))",
+        (image_id, person_id, distance))
+
+def insert_match_scores(scores):
+    """Store (image_id, face_index, person_id, distance) rows, keeping the best distance."""
+    get_connection().executemany(
+        "INSERT INTO match_scores (image_id, face_index, person_id, distance) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(image_id, face_index, person_id) DO UPDATE SET distance=MIN(distance, excluded.distance)",
+        scores)
+
+def reevaluate_matches(person_id, tolerance):
+    """Rebuild the matches of a person from the stored scores, returns the number of matched images.
+
+    Matches of images without stored scores (matched before scores existed) are kept.
+    """
+    with transaction() as conn:
+        conn.execute(
+            "DELETE FROM matches WHERE person_id=? AND image_id IN "
+            "(SELECT image_id FROM match_scores WHERE person_id=?)", (person_id, person_id))
+        c = conn.execute(
+            "INSERT INTO matches (image_id, person_id, distance) "
+            "SELECT image_id, person_id, MIN(distance) FROM match_scores "
+            "WHERE person_id=? AND distance<=? GROUP BY image_id, person_id", (person_id, tolerance))
+        return c.rowcount
+
+def get_matched_image_ids(person_id):
+    c = get_connection().cursor()
+    c.execute("SELECT image_id FROM matches WHERE person_id=?", (person_id,))
+    return set(row[0] for row in c.fetchall())
+
+def get_matched_paths(person_id):
+    """One path per image matched with the person."""
+    c = get_connection().cursor()
+    c.execute("""
+        SELECT MIN(file_paths.path) FROM matches
+        JOIN file_image_map ON file_image_map.image_id = matches.image_id
+        JOIN file_paths ON file_paths.id = file_image_map.file_path_id
+        WHERE matches.person_id=?
+        GROUP BY matches.image_id
+    """, (person_id,))
+    return [row[0] for row in c.fetchall()]
+
+def get_paths_for_image_ids(image_ids):
+    """One path per image, as {image_id: path}."""
+    image_ids = list(image_ids)
+    paths = {}
+    c = get_connection().cursor()
+    for i in range(0, len(image_ids), 500):
+        chunk = image_ids[i:i + 500]
+        c.execute(
+            "SELECT file_image_map.image_id, MIN(file_paths.path) FROM file_image_map "
+            "JOIN file_paths ON file_paths.id = file_image_map.file_path_id "
+            f"WHERE file_image_map.image_id IN ({','.join('?' * len(chunk))}) GROUP BY file_image_map.image_id", chunk)
+        paths.update(c.fetchall())
+    return paths
+
+def get_person_id(name):
+    c = get_connection().cursor()
+    c.execute("SELECT id FROM persons WHERE name=?", (name,))
+    row = c.fetchone()
+    return row[0] if row else None
+
+def link_known_image(person_id, image_id):
+    """Link an image to a person, returns False when the link already existed."""
+    c = get_connection().cursor()
+    c.execute(
+        "INSERT INTO known_images (person_id, image_id) VALUES (?, ?) "
+        "ON CONFLICT(person_id, image_id) DO NOTHING RETURNING id", (person_id, image_id))
+    return c.fetchone() is not None
+
+def add_person(name):
+    try:
+        with transaction() as conn:
+            c = conn.cursor()
+            c.execute(
+                "INSERT INTO persons (name) VALUES (?) "
+                "ON CONFLICT(name) DO UPDATE SET name=excluded.name RETURNING id", (name,))
+            return c.fetchone()[0]
+    except Exception as e:
+        logging.error(f"SQLite error in add_person: {e}")
+        return None
+
+class DBWriter(threading.Thread):
+    """Single writer thread, workers only compute and the records are flushed here in bulk.
+
+    Records (see Record) are written with executemany every batch_size records or
+    every flush_interval seconds. write(conn, batch) replaces write_records for
+    callers that queue other items, encoder_id is the encoder whose index is kept
+    up to date (default: current one). Without index the ANN index is left alone,
+    for DeepFace encoders whose encodings are only searched exhaustively.
+    committed(ok) is called after each flush, once its transaction is over.
+    """
+
+    def __init__(self, batch_size=500, flush_interval=0.5, write=None, encoder_id=None, index=True, committed=None):
+        super().__init__(name="DBWriter", daemon=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.write = write or write_records
+        self.encoder_id = encoder_id
+        self.index = index
+        self.committed = committed
+        # Bounded so that producers wait when the writer falls behind
+        self.records = Queue(maxsize=batch_size * 4)
+        self.written = 0
+
+    def put(self, record):
+        self.records.put(record)
+
+    def close(self):
+        """Flush what is pending and wait for the thread to finish."""
+        self.records.put(None)
+        self.join()
+
+    def sync(self):
+        """Wait until everything put so far is committed, the writer keeps running."""
+        synced = threading.Event()
+        self.records.put(synced)
+        synced.wait()
+
+    def run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        running = True
+        while running:
+            synced = None
+            try:
+                record = self.records.get(timeout=max(0.0, deadline - time.monotonic()))
+                if record is None:
+                    running = False
+                elif isinstance(record, threading.Event):
+                    synced = record
+                else:
+                    batch.append(record)
+            except Empty:
+                pass
+            if batch and (not running or synced or len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self.flush(batch)
+                batch = []
+                if self.index:
+                    self.update_index()
+            if synced:
+                synced.set()
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.flush_interval
+        try:
+            import ann_index
+            ann_index.save_index()
+        except Exception as e:
+            logging.error(f"Error saving ANN index: {e}")
+        close_connection()
+
+    def update_index(self):
+        """Add the encodings just flushed to the nearest neighbour index."""
+        try:
+            import ann_index, encoding_store
+            ann_index.update_index(encoding_store.get_store(self.encoder_id))
+        except Exception as e:
+            logging.error(f"Error updating ANN index: {e}")
+
+    def flush(self, batch):
+        ok = False
+        try:
+            with transaction() as conn:
+                self.write(conn, batch)
+            self.written += len(batch)
+            ok = True
+            logging.debug(f"DBWriter flushed {len(batch)} records")
+        except Exception as e:
+            logging.error(f"SQLite error in DBWriter flush of {len(batch)} records: {e}")
+        if self.committed:
+            try:
+                self.committed(ok)
+            except Exception as e:
+                logging.error(f"Error after DBWriter flush: {e}")
+
+def signature_row(signature):
+    if signature is None:
+        return None, None, None
+    phash, (width, height) = signature
+    return phash, width, height
+
+def write_records(conn, batch, encoder=None):
+    """Set based insert of Record batches, the encodings are those of the encoder (default: current one)."""
+    import encoders, encoding_store
+    encoder = encoder or encoders.current_encoder()
+    store = encoding_store.get_store(encoders.get_id(encoder))
+    c = conn.cursor()
+    c.executemany(
+        "INSERT INTO file_paths (path, hash, size, mtime_ns, inode, device) VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(path) DO UPDATE SET hash=excluded.hash, size=excluded.size, mtime_ns=excluded.mtime_ns, "
+        "inode=excluded.inode, device=excluded.device",
+        [(record.path, record.hash, *(record.stat or (None,) * 4)) for record in batch])
+    c.executemany(
+        "INSERT INTO images (hash, num_faces, phash, width, height) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(hash) DO UPDATE SET phash=COALESCE(images.phash, excluded.phash), "
+        "width=COALESCE(images.width, excluded.width), height=COALESCE(images.height, excluded.height)",
+        [(record.hash, record.num_faces, *signature_row(record.signature)) for record in batch])
+    # A modified file no longer maps to the image of its previous content
+    c.executemany(
+        "DELETE FROM file_image_map WHERE file_path_id = (SELECT id FROM file_paths WHERE path=?) "
+        "AND image_id <> (SELECT id FROM images WHERE hash=?)",
+        [(record.path, record.hash) for record in batch])
+    c.executemany(
+        "INSERT INTO file_image_map (file_path_id, image_id) "
+        "SELECT file_paths.id, images.id FROM file_paths, images WHERE file_paths.path=? AND images.hash=? "
+        "ON CONFLICT(file_path_id, image_id) DO NOTHING",
+        [(record.path, record.hash) for record in batch])
+    # Boxes are kept even when the encodings already exist, images encoded before they were stored get them.
+    # Those of a near duplicate are kept apart, so that the detector still runs on the image when it is needed.
+    derived = derived_detector(encoder.detector)
+    c.executemany(
+        "INSERT INTO faces (image_id, detector, face_index, top, right, bottom, left, landmarks) "
+        "SELECT id, ?, ?, ?, ?, ?, ?, ? FROM images WHERE hash=? "
+        "ON CONFLICT(image_id, detector, face_index) DO NOTHING",
+        [(derived if record.derived else encoder.detector, *row, record.hash) for record in batch if record.locations
+         for row in face_rows(record.locations, record.landmarks)])
+    c.executemany(
+        "INSERT INTO detections (image_id, detector, num_faces) SELECT id, ?, ? FROM images WHERE hash=? "
+        "ON CONFLICT(image_id, detector) DO NOTHING",
+        [(derived if record.derived else encoder.detector, len(record.locations), record.hash)
+         for record in batch if record.locations is not None])
+    # Encodings of images already encoded through another path are not stored twice
+    hashes = list({record.hash for record in batch if record.encodings is not None})
+    encoded = set()
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i:i + 500]
+        c.execute(
+            "SELECT images.hash FROM images JOIN image_encoders ON image_encoders.image_id = images.id "
+            f"WHERE image_encoders.encoder_id=? AND images.hash IN ({','.join('?' * len(chunk))})",
+            (store.encoder_id, *chunk))
+        encoded.update(row[0] for row in c.fetchall())
+    new_images, faces = [], []
+    for record in batch:
+        if record.encodings is not None and record.hash not in encoded:
+            encoded.add(record.hash)
+            new_images.append((store.encoder_id, len(record.encodings), record.hash))
+            faces.extend((record.hash, face_index, encoding) for face_index, encoding in enumerate(record.encodings))
+    c.executemany(
+        "INSERT INTO image_encoders (image_id, encoder_id, num_faces) SELECT id, ?, ? FROM images WHERE hash=? "
+        "ON CONFLICT(image_id, encoder_id) DO NOTHING", new_images)
+    if not faces:
+        return
+    first_row = store.append([encoding for _, _, encoding in faces])
+    c.executemany(
+        "INSERT INTO image_encodings (image_id, encoder_id, face_index, store_row) "
+        "SELECT id, ?, ?, ? FROM images WHERE hash=? "
+        "ON CONFLICT(encoder_id, image_id, face_index) DO NOTHING",
+        [(store.encoder_id, face_index, first_row + i, hash_val) for i, (hash_val, face_index, _) in enumerate(faces)])
+
+def write_encodings(conn, batch, encoder_id=None):
+    """DBWriter write for re-encoding, batch items are (image_id, encodings) of one encoder.
+
+    Scores computed from the encodings of another encoder are dropped, matches
+    are kept until the images are matched again.
+    """
+    import encoding_store
+    store = encoding_store.get_store(encoder_id)
+    c = conn.cursor()
+    c.executemany(
+        "INSERT INTO image_encoders (image_id, encoder_id, num_faces) VALUES (?, ?, ?) "
+        "ON CONFLICT(image_id, encoder_id) DO NOTHING",
+        [(image_id, store.encoder_id, len(encodings)) for image_id, encodings in batch])
+    c.executemany("DELETE FROM match_scores WHERE image_id=?", [(image_id,) for image_id, _ in batch])
+    faces = [(image_id, face_index, encoding) for image_id, encodings in batch
+             for face_index, encoding in enumerate(encodings)]
+    if not faces:
+        return
+    first_row = store.append([encoding for _, _, encoding in faces])
+    c.executemany(
+        "INSERT INTO image_encodings (image_id, encoder_id, face_index, store_row) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(encoder_id, image_id, face_index) DO NOTHING",
+        [(image_id, store.encoder_id, face_index, first_row + i) for i, (image_id, face_index, _) in enumerate(faces)])
@@ -0,0 +1,104 @@
+import logging
+import numpy as np
+
+import db
+import encoders
+import encoding_store
+import image_io
+
+# Cosine threshold of VGG-Face in DeepFace.find, used when DeepFace cannot tell
+DEFAULT_THRESHOLD = 0.68
+CHUNK_ROWS = 65536
+
+_models = {}
+
+def model_name(encoder):
+    return encoder.model[len(encoders.DEEPFACE_PREFIX):]
+
+def find_threshold(encoder):
+    """Cosine distance threshold DeepFace uses for the encoder's model."""
+    try:
+        from deepface.modules.verification import find_threshold
+        return find_threshold(model_name(encoder), "cosine")
+    except ImportError:
+        return DEFAULT_THRESHOLD
+
+def get_model(encoder):
+    """DeepFace model of the encoder, built once per process."""
+    from deepface import DeepFace
+    name = model_name(encoder)
+    if name not in _models:
+        _models[name] = DeepFace.build_model(model_name=name)
+    return _models[name]
+
+def align(buffer, encoder, max_side=None):
+    """Detect, align and preprocess the faces of an in-memory image file like DeepFace.represent.
+
+    Returns (locations, faces), boxes are (top, right, bottom, left) in original
+    image coordinates and faces the (1, h, w, 3) model inputs. The whole image
+    region DeepFace returns when it finds no face is dropped.
+    """
+    from deepface import DeepFace
+    from deepface.modules import preprocessing
+    image, scale = image_io.decode_reduced(buffer, max_side)
+    target = get_model(encoder).input_shape
+    detected = DeepFace.extract_faces(img_path=np.ascontiguousarray(image[:, :, ::-1]), detector_backend=encoder.detector,
+                                      enforce_detection=False, align=encoder.alignment == "aligned")
+    locations, faces = [], []
+    for face in detected:
+        if encoder.detector != "skip" and face.get("confidence", 1) == 0:
+            continue
+        area = face["facial_area"]
+        locations.append((area["y"], area["x"] + area["w"], area["y"] + area["h"], area["x"]))
+        # extract_faces returns RGB, the models are fed BGR as in represent
+        face_image = preprocessing.resize_image(img=face["face"][:, :, ::-1], target_size=(target[1], target[0]))
+        faces.append(preprocessing.normalize_input(img=face_image, normalization=encoder.normalization))
+    return image_io.scale_locations(locations, scale), faces
+
+def embed(faces, encoder):
+    """Embeddings of a batch of faces from align, in a single forward pass."""
+    if not faces:
+        return []
+    model = get_model(encoder)
+    output = np.asarray(model.forward(np.concatenate(faces)), dtype=np.float32)
+    if output.ndim == 1 and len(faces) > 1:
+        # DeepFace versions without batched forward only return the first embedding
+        output = np.stack([np.asarray(model.forward(face), dtype=np.float32).reshape(-1) for face in faces])
+    return list(output.reshape(len(faces), -1))
+
+def represent(buffer, encoder, max_side=None):
+    """Detect and embed the faces of an in-memory image file, returns (locations, encodings)."""
+    locations, faces = align(buffer, encoder, max_side)
+    return locations, embed(faces, encoder)
+
+def find(image_path, encoder, threshold=None, max_side=None, cancel=None):
+    """Indexed images with a face close to the first face of image_path, as [(path, distance)].
+
+    Searches the cached encodings of the encoder with the cosine distance, like
+    DeepFace.find does over its representation file. Sorted by distance. Raises
+    cancellation.Cancelled between chunks once cancel is set.
+    """
+    _, encodings = represent(image_io.read_image(image_path)[0], encoder, max_side)
+    if not encodings:
+        logging.warning(f"No face found in {image_path}")
+        return []
+    threshold = find_threshold(encoder) if threshold is None else threshold
+    query = encodings[0] / np.linalg.norm(encodings[0])
+    store = encoding_store.get_store(encoders.get_id(encoder))
+    row_image_ids, _ = encoding_store.load_row_owners(store)
+    matrix = store.matrix()
+    best = {}
+    for start in range(0, len(row_image_ids), CHUNK_ROWS):
+        if cancel is not None:
+            cancel.check()
+        chunk = np.asarray(matrix[start:start + CHUNK_ROWS], dtype=np.float32)
+        norms = np.linalg.norm(chunk, axis=1)
+        norms[norms == 0] = 1.0
+        distances = 1.0 - (chunk @ query) / norms
+        owners = row_image_ids[start:start + len(chunk)]
+        for row in np.nonzero((distances <= threshold) & (owners >= 0))[0]:
+            image_id = int(owners[row])
+            best[image_id] = min(best.get(image_id, np.inf), float(distances[row]))
+    paths = db.get_paths_for_image_ids(best.keys())
+    return sorted(((paths[image_id], distance) for image_id, distance in best.items() if image_id in paths),
+                  key=lambda match: match[1])
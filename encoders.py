@@ -0,0 +1,52 @@
+import threading
+from collections import namedtuple
+
+import db
+
+# An encoding is only comparable with encodings of the same encoder: the
+# (model, detector, alignment, normalization) key identifies what produced it,
+# dim is the length of its vectors.
+Encoder = namedtuple("Encoder", "model detector alignment normalization dim")
+
+FACE_RECOGNITION_MODEL = "dlib_face_recognition_resnet_model_v1"
+FACE_RECOGNITION_DETECTOR = "hog"
+
+# Embedding size of the DeepFace models
+DEEPFACE_DIMS = {
+    "VGG-Face": 4096, "Facenet": 128, "Facenet512": 512, "OpenFace": 128, "DeepFace": 4096,
+    "DeepID": 160, "Dlib": 128, "ArcFace": 512, "SFace": 128, "GhostFaceNet": 512,
+}
+DEEPFACE_PREFIX = "deepface:"
+
+_ids = {}
+_ids_lock = threading.Lock()
+
+def face_recognition_encoder(model="small", jitters=1):
+    """Encoder of face_recognition.face_encodings with the given landmark model and jitters."""
+    name = FACE_RECOGNITION_MODEL if jitters == 1 else f"{FACE_RECOGNITION_MODEL}_jitters_{jitters}"
+    alignment = "dlib_5_landmarks" if model == "small" else "dlib_68_landmarks"
+    return Encoder(name, FACE_RECOGNITION_DETECTOR, alignment, "none", 128)
+
+def deepface_encoder(model_name="VGG-Face", detector_backend="opencv", align=True, normalization="base"):
+    """Encoder of DeepFace.represent, the same settings DeepFace.find used for its representation files."""
+    return Encoder(f"{DEEPFACE_PREFIX}{model_name}", detector_backend, "aligned" if align else "not_aligned",
+                   normalization, DEEPFACE_DIMS.get(model_name, 0))
+
+def is_deepface(encoder):
+    return encoder.model.startswith(DEEPFACE_PREFIX)
+
+def current_encoder():
+    """face_recognition encoder of the encoding settings."""
+    import config
+    return face_recognition_encoder(getattr(config, "ENCODING_MODEL", "small"), getattr(config, "ENCODING_JITTERS", 1))
+
+def get_id(encoder=None):
+    """Id of an encoder in the encoders table, registered on first use."""
+    encoder = encoder or current_encoder()
+    key = (db.DB_PATH, encoder)
+    with _ids_lock:
+        encoder_id = _ids.get(key)
+        if encoder_id is None:
+            encoder_id = db.get_or_create_encoder(encoder)
+            _ids[key] = encoder_id
+    return encoder_id
@@ -0,0 +1,163 @@
+import os
+import logging
+import threading
+import numpy as np
+
+import db
+
+ENCODING_DIM = 128
+DTYPES = ("float32", "float16")
+
+_stores = {}
+_stores_lock = threading.Lock()
+_dtype_warned = set()
+
+class EncodingStore:
+    """Contiguous matrix of the face encodings of one encoder on disk, one row per face.
+
+    SQLite only keeps image_encodings.store_row, the matrix itself is read
+    through np.memmap so loading every encoding does not copy anything.
+    Appends must happen inside db.transaction(): BEGIN IMMEDIATE is what
+    serializes writers across processes.
+    """
+
+    def __init__(self, path, dtype="float32", dim=ENCODING_DIM, encoder_id=None):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported encoding dtype {dtype}, use one of {DTYPES}")
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.dim = dim
+        self.encoder_id = encoder_id
+        self.row_bytes = self.dtype.itemsize * dim
+        self.lock = threading.Lock()
+        self._matrix = None
+
+    def __len__(self):
+        if not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path) // self.row_bytes
+
+    def append(self, encodings):
+        """Append encodings to the matrix and return the row index of the first one."""
+        block = np.ascontiguousarray(np.asarray(encodings).reshape(-1, self.dim), dtype=self.dtype)
+        with self.lock:
+            size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+            if size % self.row_bytes:
+                # Partial row left by an interrupted append, it was never referenced
+                logging.warning(f"Truncating partial row at the end of {self.path}")
+                size -= size % self.row_bytes
+                with open(self.path, "r+b") as f:
+                    f.truncate(size)
+            with open(self.path, "ab") as f:
+                f.write(block.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        return size // self.row_bytes
+
+    def matrix(self):
+        """Read-only memory-mapped view of all rows, remapped when the file has grown."""
+        rows = len(self)
+        if rows == 0:
+            return np.empty((0, self.dim), dtype=self.dtype)
+        if self._matrix is None or self._matrix.shape[0] != rows:
+            self._matrix = np.memmap(self.path, dtype=self.dtype, mode="r", shape=(rows, self.dim))
+        return self._matrix
+
+    def get(self, rows):
+        """Encodings for the given rows as float32 (float16 stores are upcast)."""
+        rows = np.asarray(rows, dtype=np.int64)
+        if rows.size == 0:
+            return np.empty((0, self.dim), dtype=np.float32)
+        return np.asarray(self.matrix()[rows], dtype=np.float32)
+
+def store_path(dtype, encoder_id):
+    return f"{os.path.splitext(db.DB_PATH)[0]}_encodings_{encoder_id}.{dtype}"
+
+def configured_dtype():
+    import config
+    return getattr(config, "ENCODING_DTYPE", "float32")
+
+def has_rows(dtype, encoder_id):
+    path = store_path(dtype, encoder_id)
+    return os.path.exists(path) and os.path.getsize(path) > 0
+
+def encoder_dtype(encoder_id):
+    """dtype of an encoder's store, recorded with the encoder.
+
+    image_encodings.store_row does not say which file it points into, so a store
+    with rows keeps its dtype and encoding_dtype only applies to empty stores.
+    """
+    wanted = configured_dtype()
+    recorded = db.get_encoder_dtype(encoder_id)
+    if recorded == wanted:
+        return recorded
+    if recorded is not None and has_rows(recorded, encoder_id):
+        if (db.DB_PATH, encoder_id) not in _dtype_warned:
+            _dtype_warned.add((db.DB_PATH, encoder_id))
+            logging.warning(f"Encoder {encoder_id} already stores {recorded} encodings, "
+                            f"encoding_dtype {wanted} only applies to new encoders")
+        return recorded
+    with db.transaction():
+        db.set_encoder_dtype(encoder_id, wanted)
+    return wanted
+
+def get_store(encoder_id=None, dtype=None, dim=None):
+    """Return the process wide store of an encoder (default: current one) next to the database."""
+    if encoder_id is None:
+        import encoders
+        encoder_id = encoders.get_id()
+    if dtype is None:
+        dtype = encoder_dtype(encoder_id)
+    path = store_path(dtype, encoder_id)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = EncodingStore(path, dtype, dim or db.get_encoder_dim(encoder_id) or ENCODING_DIM, encoder_id)
+            _stores[path] = store
+    return store
+
+def load_row_owners(store=None):
+    """Arrays mapping each store row to its (image_id, face_index), image_id is -1 for unreferenced rows."""
+    if store is None:
+        store = get_store()
+    row_image_ids = np.full(len(store), -1, dtype=np.int64)
+    row_face_indexes = np.zeros(len(store), dtype=np.int64)
+    c = db.get_connection().cursor()
+    c.execute("SELECT store_row, image_id, face_index FROM image_encodings WHERE encoder_id=?", (store.encoder_id,))
+    data = np.array(c.fetchall(), dtype=np.int64).reshape(-1, 3)
+    data = data[data[:, 0] < len(row_image_ids)]
+    row_image_ids[data[:, 0]] = data[:, 1]
+    row_face_indexes[data[:, 0]] = data[:, 2]
+    return row_image_ids, row_face_indexes
+
+def get_row_owners(rows, store=None):
+    """{store_row: (image_id, face_index)} for the referenced rows among the given ones."""
+    if store is None:
+        store = get_store()
+    owners = {}
+    c = db.get_connection().cursor()
+    for i in range(0, len(rows), 500):
+        chunk = rows[i:i + 500]
+        c.execute(
+            "SELECT store_row, image_id, face_index FROM image_encodings "
+            f"WHERE encoder_id=? AND store_row IN ({','.join('?' * len(chunk))})", (store.encoder_id, *chunk))
+        owners.update((store_row, (image_id, face_index)) for store_row, image_id, face_index in c.fetchall())
+    return owners
+
+def migrate_blobs(c, store=None, chunk=10000):
+    """Move float64 encoding blobs of image_encodings into the store."""
+    if store is None:
+        store = get_store()
+    moved = 0
+    while True:
+        c.execute("SELECT id, encoding FROM image_encodings WHERE store_row IS NULL AND encoding IS NOT NULL LIMIT ?", (chunk,))
+        rows = c.fetchall()
+        if not rows:
+            break
+        encodings = np.stack([np.frombuffer(blob, dtype=np.float64) for _, blob in rows])
+        first_row = store.append(encodings)
+        c.executemany("UPDATE image_encodings SET store_row=?, encoding=NULL WHERE id=?",
+                      [(first_row + i, row_id) for i, (row_id, _) in enumerate(rows)])
+        moved += len(rows)
+    if moved:
+        logging.info(f"Moved {moved} encodings into {store.path}")
@@ -1,291 +1,92 @@
 import os,time
-import os.path as osp
 import shutil,sys
 import logging, traceback
+import argparse
 import threading, multiprocessing
-from multiprocessing import Pool, cpu_count
 import random
-import hashlib
-import json
-import concurrent.futures
-from deepface import DeepFace
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 import matplotlib.image as mpimg
 from datetime import datetime
 import utils, config
-import numpy as np
 from tabulate import tabulate
-from queue import Queue
+from queue import Queue, Empty
 from pathlib import Path
 from tkinter import filedialog, messagebox, simpledialog
 import customtkinter as ctk
 from PIL import Image
 from PIL.ExifTags import TAGS
 import mimetypes
-import pickle
 import pandas as pd
-import sqlite3
+import db
+import image_io
+import matching
+import pipeline
+import ann_index
+import encoders
+import deepface_search
+import representations
+import thumbnails
+import worker_pool
+import cancellation
 
 lock = threading.Lock()
-DB_PATH = "face_recognition.db"
+# How often display_image checks whether a thumbnail made in the background is ready
+THUMBNAIL_POLL_MS = 100
+# How often the window handles the events posted by the background job
+EVENT_POLL_MS = 100
+# Longest wait on exit for the cancelled job to write what it has done
+EXIT_TIMEOUT = 10
 
-def init_db():
-    try:
-        conn = sqlite3.connect(DB_PATH,timeout=10)
-
-        c = conn.cursor()
-        # Table for file paths (can have same hash in different locations)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS file_paths (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                path TEXT UNIQUE
-            )
-        """)
-        # Table for images (hash and metadata, not tied to path)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS images (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                hash TEXT,
-                num_faces INTEGER
-            )
-        """)
-        # Table for mapping file path to image hash
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS file_image_map (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                file_path_id INTEGER,
-                image_id INTEGER,
-                FOREIGN KEY(file_path_id) REFERENCES file_paths(id),
-                FOREIGN KEY(image_id) REFERENCES images(id),
-                UNIQUE(file_path_id, image_id)
-            )
-        """)
-        # Table for matches (now with person_id instead of encoding)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS matches (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                image_id INTEGER,
-                person_id INTEGER,
-                FOREIGN KEY(image_id) REFERENCES images(id),
-                FOREIGN KEY(person_id) REFERENCES persons(id)
-            )
-        """)
-        # Table for persons
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS persons (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT UNIQUE
-            )
-        """)
-        # Table for known images (used for known encodings)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS known_images (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                person_id INTEGER,
-                image_id INTEGER,
-                FOREIGN KEY(person_id) REFERENCES persons(id),
-                FOREIGN KEY(image_id) REFERENCES images(id)
-            )
-        """)
-        # Table for all encodings per image
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS image_encodings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                image_id INTEGER,
-                encoding BLOB,
-                UNIQUE(image_id, encoding),
-                FOREIGN KEY(image_id) REFERENCES images(id)
-            )
-        """)
-        conn.commit()
-    except Exception as e:
-        logging.error(f"SQLite error in init_db: {e}")
-    finally:
-        conn.close()
-
-def hash_image(file_path):
-    with open(file_path, "rb") as f:
-        return hashlib.sha256(f.read()).hexdigest()
-
-def get_or_create_file_path(path):
-    try:
-        conn = sqlite3.connect(DB_PATH,timeout=10)
-
-        c = conn.cursor()
-        c.execute("SELECT id FROM file_paths WHERE path=?", (path,))
-        row = c.fetchone()
-        if row:
-            file_path_id = row[0]
-        else:
-            c.execute("INSERT INTO file_paths (path) VALUES (?)", (path,))
-            conn.commit()
-            file_path_id = c.lastrowid
-        conn.close()
-        return file_path_id
-    except Exception as e:
-        logging.error(f"SQLite error in get_or_create_file_path: {e}")
-        return None
-
-def get_or_create_image(hash_val, num_faces):
-    try:
-        conn = sqlite3.connect(DB_PATH,timeout=10)
-
-        c = conn.cursor()
-        c.execute("SELECT id FROM images WHERE hash=?", (hash_val,))
-        row = c.fetchone()
-        if row:
-            image_id = row[0]
-        else:
-            c.execute("INSERT INTO images (hash, num_faces) VALUES (?, ?)", (hash_val, num_faces))
-            conn.commit()
-            image_id = c.lastrowid
-        conn.close()
-        return image_id
-    except Exception as e:
-        logging.error(f"SQLite error in get_or_create_image: {e}")
-        return None
-
-def map_file_to_image(file_path_id, image_id):
-    try:
-        conn = sqlite3.connect(DB_PATH,timeout=10)
-
-        c = conn.cursor()
-        c.execute("SELECT id FROM file_image_map WHERE file_path_id=? AND image_id=?", (file_path_id, image_id))
-        row = c.fetchone()
-        if not row:
-            c.execute("INSERT INTO file_image_map (file_path_id, image_id) VALUES (?, ?)", (file_path_id, image_id))
-            conn.commit()
-        conn.close()
-    except Exception as e:
-        logging.error(f"SQLite error in map_file_to_image: {e}")
-
-def insert_image_encoding(image_id, encoding):
-    try:
-        conn = sqlite3.connect(DB_PATH,timeout=10)
-
-        c = conn.cursor()
-        c.execute("SELECT id FROM image_encodings WHERE image_id=? AND encoding=?", (image_id, encoding.tobytes()))
-        exists = c.fetchone()
-        if not exists:
-            c.execute("INSERT INTO image_encodings (image_id, encoding) VALUES (?, ?)", (image_id, encoding.tobytes()))
-            conn.commit()
-        conn.close()
-    except Exception as e:
-        logging.error(f"SQLite error in insert_image_encoding: {e}")
-
-def insert_match(image_id, person_id):
-    try:
-        conn = sqlite3.connect(DB_PATH,timeout=10)
-
-        c = conn.cursor()
-        # Ensure only one match per image/person
-        c.execute("SELECT id FROM matches WHERE image_id=? AND person_id=?", (image_id, person_id))
-        exists = c.fetchone()
-        if not exists:
-            c.execute("INSERT INTO matches (image_id, person_id) VALUES (?, ?)", (image_id, person_id))
-            conn.commit()
-        else:
-            logging.info(f"Match already exists for image_id={image_id} and person_id={person_id}, skipping.")
-        conn.close()
-    except Exception as e:
-        logging.error(f"SQLite error in insert_match: {e}")
-
-def add_person(name):
-    try:
-        conn = sqlite3.connect(DB_PATH,timeout=10)
-
-        c = conn.cursor()
-        c.execute("INSERT OR IGNORE INTO persons (name) VALUES (?)", (name,))
-        conn.commit()
-        c.execute("SELECT id FROM persons WHERE name=?", (name,))
-        person_id = c.fetchone()[0]
-        conn.close()
-        return person_id
-    except Exception as e:
-        logging.error(f"SQLite error in add_person: {e}")
-        return None
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
 
 def add_known_image_for_person(person_id, image_path):
+    """Link a reference image to a person and match it against the already indexed library.
+
+    Returns the number of images newly matched with the person.
+    """
     try:
-        hash_val = hash_image(image_path)
-        image = face_recognition.load_image_file(image_path)
-        encodings = face_recognition.face_encodings(image)
+        buffer, hash_val = image_io.read_image(image_path)
+        locations, encodings, landmarks = pipeline.detect_faces(buffer, landmarks=config.STORE_LANDMARKS,
+                                                                 **pipeline.encoder_options())
         num_faces = len(encodings)
-        image_id = get_or_create_image(hash_val, num_faces)
-        # Check if already linked
-        conn = sqlite3.connect(DB_PATH,timeout=10)
-
-        c = conn.cursor()
-        c.execute("SELECT id FROM known_images WHERE person_id=? AND image_id=?", (person_id, image_id))
-        exists = c.fetchone()
-        if exists:
-            logging.info(f"Image {image_path} already linked to person ID {person_id}, skipping.")
-            conn.close()
-            return
-        # Save encodings
-        for encoding in encodings:
-            insert_image_encoding(image_id, encoding)
-        # Link image to person
-        c.execute("INSERT INTO known_images (person_id, image_id) VALUES (?, ?)", (person_id, image_id))
-        conn.commit()
-        conn.close()
+        with db.transaction():
+            image_id = db.get_or_create_image(hash_val, num_faces)
+            # Link image to person, skip if already linked
+            if not db.link_known_image(person_id, image_id):
+                logging.info(f"Image {image_path} already linked to person ID {person_id}, skipping.")
+                return 0
+            # Save boxes and encodings
+            encoder = encoders.current_encoder()
+            db.insert_faces(image_id, encoder.detector, locations, landmarks)
+            for face_index, encoding in enumerate(encodings):
+                db.insert_image_encoding(image_id, face_index, encoding)
+            db.mark_encoded(image_id, encoders.get_id(encoder), num_faces)
         logging.info(f"Linked image {image_path} to person ID {person_id}")
+        return retroactive_match(person_id, encodings)
     except Exception as e:
         logging.error(f"Error adding known image for person: {e}")
-
-def process_image_for_queue(img):
-        try:
-            formatted_path = Path(img)
-            hash_val = hash_image(img)
-            file_path_id = get_or_create_file_path(str(formatted_path))
-            try:
-                #TODO: implement connection pooling
-                conn = sqlite3.connect(DB_PATH,timeout=10)
-
-                c = conn.cursor()
-                c.execute(
-                    "SELECT images.id, images.num_faces FROM images "
-                    "JOIN file_image_map ON images.id = file_image_map.image_id "
-                    "WHERE file_image_map.file_path_id=? AND images.hash=?",
-                    (file_path_id, hash_val)
-                )
-                row = c.fetchone()
-            except Exception as e:
-                logging.warning(f"Database error for {img}: {e}")
-                row = None
-            finally:
-                conn.close()
-
-            if row:
-                image_id, num_faces = row
-                encodings = []
-                logging.info(f"Image queued: {img} (existing hash, no re-encoding)")
-            else:
-                try:
-                    image = face_recognition.load_image_file(img)
-                    encodings = face_recognition.face_encodings(image)
-                    num_faces = len(encodings)
-                    image_id = get_or_create_image(hash_val, num_faces)
-                    logging.info(f"Image queued: {img} (encoded, new hash)")
-                except Exception as e:
-                    logging.warning(f"Error encoding image {img}: {e}")
-                    encodings = []
-                    num_faces = 0
-                    image_id = get_or_create_image(hash_val, num_faces)
-
-            map_file_to_image(file_path_id, image_id)
-
-            if encodings:
-                for encoding in encodings:
-                    insert_image_encoding(image_id, encoding)
-
-            if num_faces > 0:
-                return str(formatted_path)
-        except Exception as e:
-            logging.warning(f"Error processing image {img}: {e}")
-        return None
-
+        return 0
+
+def retroactive_match(person_id, encodings):
+    """Search new reference encodings of a person in the encodings already stored."""
+    if not encodings:
+        return 0
+    start = time.perf_counter()
+    engine = matching.MatchingEngine(encodings, [person_id] * len(encodings), config.TOLERANCE)
+    scores = matching.scan_store(engine)
+    matched = matching.best_matches(scores, engine.tolerance)
+    already_matched = db.get_matched_image_ids(person_id)
+    with db.transaction():
+        db.insert_match_scores(scores)
+        for image_id, persons in matched.items():
+            db.insert_match(image_id, person_id, persons[person_id])
+    new_matches = len(matched.keys() - already_matched)
+    logging.info(f"Retroactive match of person ID {person_id}: {new_matches} new images matched "
+                 f"in {time.perf_counter() - start:.2f}s")
+    return new_matches
 
 # Example usage:
 # person_id = add_person("John Doe")
@@ -382,8 +183,11 @@ class FaceRecognitionApp(ctk.CTk):
 
         self.root_folder = None
         self.matching_folders = []
-        self.image_queue = Queue()
         self.current_image = None
+        # Background jobs never touch the widgets, they post (kind, args) events handled by poll_events
+        self.events = Queue()
+        self.job = None
+        self.cancel_token = cancellation.CancelToken()
         
         self.root_folder = config.configfile.get("Settings", "root_folder", fallback="")
         self.output_folder = config.configfile.get("Settings", "output_folder", fallback="")
@@ -404,12 +208,73 @@ class FaceRecognitionApp(ctk.CTk):
 
         self.update_random_face()
         self.update_ui()
+        self.poll_events()
 
-    def update_random_face(self):
+    def run_job(self, name, target, *args):
+        """Run target(*args) in a background thread, one job at a time.
+
+        The job stops at the next check of self.cancel_token once it is cancelled.
+        """
+        if self.job is not None and self.job.is_alive():
+            messagebox.showwarning("Busy", f"{self.job.name} is still running.")
+            return
+        self.cancel_token = cancellation.CancelToken()
+        self.progress_bar.set(0)
+        self.label.configure(text=f"{name}...")
+        self.job = threading.Thread(target=self.job_main, args=(name, target, args), name=name, daemon=True)
+        self.job.start()
+
+    def job_main(self, name, target, args):
         try:
-            conn = sqlite3.connect(DB_PATH,timeout=10)
+            target(*args)
+        except cancellation.Cancelled:
+            logging.warning(f"{name} cancelled")
+            self.post("status", f"{name} cancelled")
+        except Exception as e:
+            logging.error(f"Error in {name}: {e}")
+            logging.debug(traceback.format_exc())
+            self.post("error", "Error", f"{name} failed: {e}")
+        finally:
+            self.post("done", name)
+
+    def post(self, kind, *args):
+        """Queue an event for the Tk thread, safe to call from any thread."""
+        self.events.put((kind, args))
+
+    def report_progress(self, progress):
+        self.post("progress", progress)
+
+    def poll_events(self):
+        try:
+            while True:
+                kind, args = self.events.get_nowait()
+                if kind == "status":
+                    self.label.configure(text=args[0])
+                elif kind == "progress":
+                    self.show_progress(args[0])
+                elif kind == "info":
+                    messagebox.showinfo(*args)
+                elif kind == "error":
+                    messagebox.showerror(*args)
+                elif kind == "done":
+                    logging.info(f"{args[0]} finished")
+        except Empty:
+            pass
+        self.after(EVENT_POLL_MS, self.poll_events)
+
+    def show_progress(self, progress):
+        """Show a pipeline.Pipeline.progress() snapshot in the progress bar and the status label."""
+        if progress["fraction"] is not None:
+            self.progress_bar.set(progress["fraction"])
+        eta = format_duration(progress["eta"]) if progress["scan_done"] and progress["eta"] is not None else "-"
+        self.label.configure(text=(
+            f"Scanned {progress['scanned']}, hashed {progress['read'] - progress['unchanged']}, "
+            f"encoded {progress['encoded']}, matched {progress['matched']} | "
+            f"{progress['rate']:.1f} images/s, ETA {eta}"))
 
-            c = conn.cursor()
+    def update_random_face(self):
+        try:
+            c = db.get_connection().cursor()
             # Get a random known image and its person
             c.execute("""
                 SELECT images.hash, images.num_faces, file_paths.path, persons.name
@@ -421,7 +286,6 @@ class FaceRecognitionApp(ctk.CTk):
                 ORDER BY RANDOM() LIMIT 1
             """)
             row = c.fetchone()
-            conn.close()
             if not row:
                 logging.warning("No known images found in database!")
                 self.image_label.configure(text="No known image")
@@ -440,15 +304,14 @@ class FaceRecognitionApp(ctk.CTk):
             self.image_label.configure(text="Error displaying image")
 
     def display_image(self, file_path, label):
-        logging.info(f"Displaying {file_path}")
-        f = open(file_path, 'rb')
+        """Show the thumbnail of file_path in label, polling until the background thread has made it."""
         try:
-            image = Image.open(f)
-            aspect_ratio = image.width / image.height
-            new_width = 200
-            new_height = int(new_width / aspect_ratio)
-            image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            photo = ctk.CTkImage(light_image=image, dark_image=image, size=(new_width, new_height))
+            image = thumbnails.get_cache().get(file_path)
+            if image is None:
+                self.after(THUMBNAIL_POLL_MS, self.display_image, file_path, label)
+                return
+            logging.info(f"Displaying {file_path}")
+            photo = ctk.CTkImage(light_image=image, dark_image=image, size=image.size)
             label.configure(image=photo)
             label.image = photo
         except Exception as e:
@@ -486,8 +349,16 @@ class FaceRecognitionApp(ctk.CTk):
 
     def exit_app(self):
         logging.info("Exiting Application")
-        config.stop_flag=True
-        time.sleep(10)
+        self.cancel_token.cancel()
+        self.wait_job_exit(time.monotonic() + EXIT_TIMEOUT)
+
+    def wait_job_exit(self, deadline):
+        """Quit once the cancelled job has flushed its writes, keeping the window responsive meanwhile."""
+        if self.job is not None and self.job.is_alive():
+            if time.monotonic() < deadline:
+                self.after(EVENT_POLL_MS, self.wait_job_exit, deadline)
+                return
+            logging.warning(f"{self.job.name} still running, exiting anyway")
         self.quit()
 
     def get_date_taken(self,path):
@@ -534,209 +405,77 @@ class FaceRecognitionApp(ctk.CTk):
                 logging.debug(traceback.format_exc())
 
     def count_images_in_folders(self):
-        total_images = 0
-        for folder in self.matching_folders:
-            try:
-                image_files = [f for f in os.listdir(folder) if f.lower().endswith(('jpg', 'jpeg', 'png'))]
-                total_images += len(image_files)
-            except Exception as e:
-                logging.warning(f"Error accessing folder '{folder}': {e}")
-                continue
-        return total_images
+        return sum(1 for _ in image_io.iter_image_files(self.matching_folders))
 
     
     def queue_images(self, folders=None):
-        logging.info("Building image list with multiprocessing")
-        queued_images = []
-        total_images = 0
+        """Index the images of the folders without matching them."""
+        logging.info("Indexing images through the pipeline")
         folders = folders or self.matching_folders
-
-        image_files = []
-        for folder in folders:
-            try:
-                files = [
-                    os.path.join(folder, f)
-                    for f in os.listdir(folder)
-                    if f.lower().endswith(('jpg', 'jpeg', 'png'))
-                ]
-                total_images += len(files)
-                image_files.extend(files)
-            except Exception as e:
-                logging.warning(f"Error accessing folder '{folder}': {e}")
-
-        with Pool(processes=cpu_count()) as pool:
-            results = pool.map(process_image_for_queue, image_files)
-            for result in results:
-                if result:
-                    self.image_queue.put(Path(result))
-                    queued_images.append(result)
-
+        stats = pipeline.Pipeline(folders, on_progress=self.report_progress, cancel=self.cancel_token,
+                                  resumable=True).run()
+        self.cancel_token.check()
         logging.info(
-            f"Queued {len(queued_images)} images for processing (out of {total_images} total found)."
+            f"Queued {stats['queued']} images for processing (out of {stats['read']} total read, "
+            f"{stats['unchanged']} unchanged), {stats['written']} written to database."
         )
+        self.post("status", f"Indexed {stats['read']} images, {stats['queued']} with faces")
 
 
     def start_comparison(self):
-        thread = threading.Thread(target=self.compare_faces)
-        thread.start()
-              
-    def compare_faces_old(self):
-        """Compare faces using multiprocessing with detailed logging for each processed file."""
         if not self.selected_image_path:
             messagebox.showerror("Error", "Please select an image and a root folder with matching subfolders!")
             return
         if not self.output_folder or not os.path.exists(self.output_folder):
             messagebox.showerror("Error", "Please select a folder to hold images that matches !")
             return
+        self.run_job("Image comparison", self.compare_faces)
+              
+    def compare_faces_old(self):
+        """Compare faces using multiprocessing with detailed logging for each processed file.
 
+        Runs as a background job (run_job), the inputs are checked by start_comparison.
+        """
         output_folder = self.output_folder
         os.makedirs(output_folder, exist_ok=True)
-        self.label.configure(text=f"Starting image comparison")
+        self.post("status", "Starting image comparison")
         
-        logging.info("Building list of files")
-        self.queue_images()  # Populate the queue
-        config.total_images = self.image_queue.qsize()
-
-        logging.info(f"{config.total_images} images to process")
+        logging.info(f"Loading known faces")
+        engine = matching.MatchingEngine.from_db(config.TOLERANCE)
+        if not len(engine):
+            raise ValueError("No face found in the known images!")
         config.processed_count = 0
-        logging.info(f"Encoding known faces")
-        known_encodings = load_known_encodings(self.selected_image_path)
-        if not known_encodings:
-            raise ValueError("No face found in the selected image!")
 
-        known_encodings_list = [enc.tolist() for enc in known_encodings]
-        logging.info(f"Start processing with {config.WORKERS} workers")
-        
-        with concurrent.futures.ProcessPoolExecutor(
-            max_workers=config.WORKERS, initializer=worker_init, initargs=(os.getpid(),)
-        ) as executor:
-            futures = {}
-            while not self.image_queue.empty():
-                file_path = self.image_queue.get()
-                future = executor.submit(process_image, file_path, output_folder,known_encodings_list)
-                futures[future] = file_path
-
-            for future in concurrent.futures.as_completed(futures):
-                file_path = futures[future]
-                process_name = f"FaceRecWorker"
-                try:
-                    result = future.result()
-                    
-                    # **LOG EVERY FILE PROCESSED**
-                    logging.info(f"Processed: {file_path}")
-                    
-                    if result:
-                        logging.info(f"Image {file_path} matches with known face")
-                        # Copy file with new name
-                        output_file_path=build_matches_file(file_path,output_folder)
-                        if not os.path.exists(output_file_path):
-                            shutil.copy(file_path,output_file_path)
-                        else:
-                            logging.info(f"File {file_path} already exists")
-                        with lock:
-                            config.matches_found.append(file_path)
-                    if config.stop_flag==True:
-                        logging.warning("Stop flag detected. Cancelling remaining processing.")
-                        for future in futures:
-                            future.cancel()
-                        return None
-                    with lock:
-                        config.processed_count += 1
-                        config.processed_files.append(file_path)
-                except concurrent.futures.process.BrokenProcessPool as e:
-                    logging.warning(f"{process_name}: {e}")
-                    return None
-                except Exception as e:
-                    logging.error(f"{process_name}: Error processing {file_path}: {e}")
-                    logging.error(traceback.format_exc())
+        def on_queued(file_path):
+            with lock:
+                config.processed_count += 1
+                config.processed_files.append(file_path)
+
+        def on_match(file_path):
+            logging.info(f"Image {file_path} matches with known face")
+            with lock:
+                config.matches_found.append(file_path)
+
+        # Scanning, encoding and matching overlap instead of running as two full passes
+        logging.info(f"Matching images against {len(engine)} known encodings")
+        # Resumable: after a crash or an exit the next comparison carries on with the files left
+        stats = pipeline.Pipeline(self.matching_folders, engine, output_folder, on_queued=on_queued, on_match=on_match,
+                                  on_progress=self.report_progress, cancel=self.cancel_token, resumable=True).run()
+        config.total_images = stats["read"]
+        self.cancel_token.check()
 
         logging.info("All images processed")
-        os.remove(config.QUEUE_FILE)
         # Show results
         if config.matches_found:
-            messagebox.showinfo("Matches Found", f"{len(config.matches_found)} Matching Images copied to 'matched_faces' folder.")
+            self.post("info", "Matches Found", f"{len(config.matches_found)} Matching Images copied to 'matched_faces' folder.")
         else:
-            messagebox.showinfo("No Match", "No matching images found!")
+            self.post("info", "No Match", "No matching images found!")
         return None
     
-    def make_json_safe(self,obj, ignore_keys=None):
-        """
-        Recursively convert any Python object into a JSON-serializable,
-        order-stable form so hashing is deterministic.
-        Keys listed in ignore_keys are removed from dicts.
-        """
-        if ignore_keys is None:
-            ignore_keys = set()
-
-        if isinstance(obj, dict):
-            return {
-                k: self.make_json_safe(v, ignore_keys)
-                for k, v in sorted(obj.items())
-                if k not in ignore_keys
-            }
-        elif isinstance(obj, (list, tuple)):
-            return [self.make_json_safe(v, ignore_keys) for v in obj]
-        elif isinstance(obj, set):
-            return sorted(self.make_json_safe(v, ignore_keys) for v in obj)
-        else:
-            return obj
-
-    def stable_hash(self,obj, ignore_keys=None):
-        """
-        Create a stable SHA256 hash for any nested Python structure.
-        ignore_keys: set of dict keys to skip when hashing.
-        """
-        safe_obj = self.make_json_safe(obj, ignore_keys)
-        canonical_str = json.dumps(safe_obj, sort_keys=True, separators=(',', ':'))
-        return hashlib.sha256(canonical_str.encode()).hexdigest()
-
-    def has_duplicates(data_list, ignore_keys=None):
-        seen = set()
-        for item in data_list:
-            h = self.stable_hash(item, ignore_keys)
-            if h in seen:
-                return True
-            seen.add(h)
-        return False
-
-    def unique_records(self,data_list, ignore_keys=None):
-        seen = set()
-        result = []
-        for item in data_list:
-            h = self.stable_hash(item, ignore_keys)
-            if h not in seen:
-                seen.add(h)
-                result.append(item)
-        return result
-
     def combine_pickle_files(self,directory_path, output_file):
-        #   combined_df = pd.DataFrame()  # Initialize an empty DataFrame to store the merged data
-        combined_rep=[]
         try:
-            for file_name in os.listdir(directory_path):
-                if file_name.endswith('.pkl'):
-                    file_path = osp.join(directory_path, file_name)
-                    with open(file_path, 'rb') as f:
-                        content = pickle.load(f)
-                        if isinstance(content, list):  # Ensure the data is a list
-                            combined_rep.extend(content)
-                        else:
-                            logging.warning(f"Warning: {file_path} does not contain a list!")
-            
-            for item in combined_rep:
-                file_id=item['identity']
-                #path_file_id=Path(item['identity'])
-                #if file_id != path_file_id:
-                #    logging.debug(f"Diff: {file_id} / {path_file_id}")
-                #    item['identity']=path_file_id
-                for r, _, f in os.walk(file_id):
-                    for file in f:
-                        exact_path = os.path.join(r, file)
-                        item['identity']=exact_path
-            combined_rep_nodup=self.unique_records(combined_rep)
-
-            with open(output_file, 'wb') as out:
-                pickle.dump(combined_rep_nodup, out, protocol=pickle.HIGHEST_PROTOCOL)
+            count = representations.merge_pickles(directory_path, output_file, self.root_folder or None)
+            logging.info(f"Combined {count} representations into {output_file}")
         except Exception as e:
                 logging.error(f"Error combining pickle files : {e}")
                 logging.debug(traceback.format_exc())
@@ -749,60 +488,36 @@ class FaceRecognitionApp(ctk.CTk):
         return matching_files
 
     def compare_faces(self):
-        """Compare faces using multiprocessing with detailed logging for each processed file."""
-        if not self.selected_image_path:
-            messagebox.showerror("Error", "Please select an image and a root folder with matching subfolders!")
-            return
-        if not self.output_folder or not os.path.exists(self.output_folder):
-            messagebox.showerror("Error", "Please select a folder to hold images that matches !")
-            return
+        """Compare faces using multiprocessing with detailed logging for each processed file.
 
+        Runs as a background job (run_job), the inputs are checked by start_comparison.
+        """
         output_folder = self.output_folder
         os.makedirs(output_folder, exist_ok=True)
-        self.label.configure(text=f"Starting image comparison")
+        self.post("status", "Starting image comparison")
 
         image_files = [f for f in os.listdir(self.selected_image_path) if f.lower().endswith(('jpg', 'jpeg', 'png'))]
         one_image=os.path.join(self.selected_image_path,image_files[0])
 
-        logging.info("Merge all pickle files found in subdir")
-        try:
-            pkl_file_name="ds_model_vggface_detector_opencv_aligned_normalization_base_expand_0.pkl"
-            file_path = osp.join(self.root_folder, pkl_file_name)
-            if os.path.exists(file_path) and os.path.exists(os.path.join(self.root_folder,"merged",pkl_file_name)):
-                shutil.copyfile(file_path, utils.add_timestamp_suffix(file_path))
-                #with open(file_path, 'rb') as f:
-                    #content = pickle.load(f)os.path.join(self.root_folder,"merged",pkl_file_name)
-                    #logging.debug(json.dumps(content, indent=4))
-
-                shutil.copyfile(file_path, os.path.join(self.root_folder,"merged",pkl_file_name))
-
-            # if other plk file found with same name in subdir, merge them
-            matching_pkl_files=[]
-            matching_pkl_files=self.find_files_with_name(self.root_folder, pkl_file_name)
-            logging.debug(f"matching pkl files {matching_pkl_files}")
-            i=0
-            for matching_pkl in matching_pkl_files:
-                i+=1
-                matching_pkl_file_name = os.path.basename(matching_pkl)
-                matching_pkl_file_name = utils.add_suffix(matching_pkl_file_name,str(i)) 
-                new_file_path=os.path.join(self.root_folder,"merged",matching_pkl_file_name) 
-                if os.path.exists(os.path.join(self.root_folder,"merged")):
-                    logging.info(f"copy {matching_pkl} to {new_file_path}")
-                    shutil.copyfile(matching_pkl, new_file_path)
-            #if os.path.exists(os.path.join(self.root_folder,"merged")):
-            #    self.combine_pickle_files(os.path.join(self.root_folder,"merged"),file_path)
-
-        except Exception as e:
-                logging.error(f"Error Merging pickle files : {e}")
-                logging.debug(traceback.format_exc())
-
-        time.sleep(5)
-        logging.debug(f"DeepFace find with {one_image}")
-        results=[]
-        results = DeepFace.find(img_path = one_image, db_path = self.root_folder,enforce_detection=False)
+        # Only the images the DeepFace encoder has not embedded yet are encoded, the
+        # search then runs on the cached encodings instead of a representation file.
+        # Representation files left by DeepFace.find are imported once beforehand.
+        logging.info("Encode the root folder images missing from the DeepFace encoding cache")
+        encoder = encoders.deepface_encoder()
+        self.post("status", "Importing DeepFace representation files")
+        representations.import_pickles(self.root_folder, encoder, self.cancel_token)
+        self.cancel_token.check()
+        folders = [dirpath for dirpath, _, _ in os.walk(self.root_folder)]
+        pipeline.Pipeline(folders, encoder=encoder, on_progress=self.report_progress, cancel=self.cancel_token,
+                          resumable=True).run()
+        self.cancel_token.check()
+
+        logging.debug(f"DeepFace search with {one_image}")
+        self.post("status", f"Searching the faces of {image_files[0]}")
+        matches = deepface_search.find(one_image, encoder, max_side=config.MAX_DETECTION_SIDE, cancel=self.cancel_token)
 
         try:
-            pd_results=results[0] #corresponds to the identity information for one individual detected in the source image.
+            pd_results=pd.DataFrame(matches, columns=["identity", "distance"]) #matches of the first face detected in the source image.
             logging.debug(tabulate(pd_results, headers='keys', tablefmt='psql'))
             named_one_image=utils.clean_string(image_files[0])
             pd_results.to_csv(f"data_{named_one_image}.csv", index=False)
@@ -822,9 +537,11 @@ class FaceRecognitionApp(ctk.CTk):
                 logging.debug(traceback.format_exc())
         # Show results
         if config.matches_found:
-            messagebox.showinfo("Matches Found", f"{len(config.matches_found)} Matching Images copied to 'matched_faces' folder.")
+            self.post("status", f"{len(config.matches_found)} matching images")
+            self.post("info", "Matches Found", f"{len(config.matches_found)} Matching Images copied to 'matched_faces' folder.")
         else:
-            messagebox.showinfo("No Match", "No matching images found!")
+            self.post("status", "No matching images")
+            self.post("info", "No Match", "No matching images found!")
         return None
     
     def update_ui(self):
@@ -838,14 +555,14 @@ class FaceRecognitionApp(ctk.CTk):
             messagebox.showerror("Error", "Please select a root folder first!")
             return
         logging.info("Queueing only images in root folder")
-        self.queue_images(folders=[self.root_folder])
+        self.run_job("Queueing root folder images", self.queue_images, [self.root_folder])
 
     def gui_add_person(self):
         name = self.person_name_entry.get().strip()
         if not name:
             messagebox.showerror("Error", "Please enter a person name.")
             return
-        person_id = add_person(name)
+        person_id = db.add_person(name)
         if person_id:
             messagebox.showinfo("Success", f"Person '{name}' added with ID {person_id}.")
             self.refresh_persons_optionmenu()
@@ -854,12 +571,9 @@ class FaceRecognitionApp(ctk.CTk):
 
     def refresh_persons_optionmenu(self):
         try:
-            conn = sqlite3.connect(DB_PATH,timeout=10)
-
-            c = conn.cursor()
+            c = db.get_connection().cursor()
             c.execute("SELECT name FROM persons")
             persons = [row[0] for row in c.fetchall()]
-            conn.close()
             self.persons_optionmenu.configure(values=persons)
             if persons:
                 self.persons_optionmenu_var.set(persons[0])
@@ -873,12 +587,9 @@ class FaceRecognitionApp(ctk.CTk):
         if not person_name:
             messagebox.showerror("Error", "Please select a person.")
             return
-        conn = sqlite3.connect(DB_PATH,timeout=10)
-
-        c = conn.cursor()
+        c = db.get_connection().cursor()
         c.execute("SELECT id FROM persons WHERE name=?", (person_name,))
         row = c.fetchone()
-        conn.close()
         if not row:
             messagebox.showerror("Error", "Selected person not found in database.")
             return
@@ -888,100 +599,83 @@ class FaceRecognitionApp(ctk.CTk):
             filetypes=[("Image Files", "*.jpg *.jpeg *.png")]
         )
         if image_path:
-            add_known_image_for_person(person_id, image_path)
-            messagebox.showinfo("Success", f"Image linked to person '{person_name}'.")
+            self.run_job("Linking known image", self.link_known_image, person_id, person_name, image_path)
         else:
             messagebox.showwarning("No Image Selected", "No image was selected.")
 
-
-def build_matches_file(file_path,output_folder):
-    parent_folder = os.path.basename(os.path.dirname(file_path))
-    file_name = os.path.basename(file_path)
-    new_file_name = f"{parent_folder}_{file_name}"
-    return os.path.join(output_folder, new_file_name)
-
-def load_known_encodings_from_db():
-    known_encodings = []
-    known_person_ids = []
-    try:
-        conn = sqlite3.connect(DB_PATH,timeout=10)
-
-        c = conn.cursor()
-        # Get all persons and their known images
-        c.execute("""
-            SELECT persons.id, image_encodings.encoding
-            FROM known_images
-            JOIN persons ON known_images.person_id = persons.id
-            JOIN image_encodings ON known_images.image_id = image_encodings.image_id
-        """)
-        rows = c.fetchall()
-        for person_id, encoding_blob in rows:
-            encoding = np.frombuffer(encoding_blob, dtype=np.float64)
-            known_encodings.append(encoding)
-            known_person_ids.append(person_id)
-    except Exception as e:
-        logging.error(f"SQLite error in load_known_encodings_from_db: {e}")
-    finally:
-        conn.close()
-    if not known_encodings:
-        logging.error("No valid face encodings found in known_images/image_encodings tables!")
-    logging.debug(f"Known encodings: {known_encodings}, Known person IDs: {known_person_ids}")
-    return known_encodings, known_person_ids
-
-def process_image(file_path, output_folder, known_encodings_list, known_person_ids):
-    try:
-        output_file_path = build_matches_file(file_path, output_folder)
-        if os.path.exists(output_file_path):
-            return file_path
-        # Load the image and get encodings
-        # TODO: load encodings from database if it exists
-        
-        unknown_image = face_recognition.load_image_file(file_path)
-        unknown_encodings = face_recognition.face_encodings(unknown_image)
-        known_encodings = [np.array(enc) for enc in known_encodings_list]
-
-        # Get image_id for this file
-        hash_val = hash_image(file_path)
-        conn = sqlite3.connect(DB_PATH,timeout=10)
-
-        c = conn.cursor()
-        c.execute("SELECT id FROM images WHERE hash=?", (hash_val,))
-        row = c.fetchone()
-        image_id = row[0] if row else None
-        conn.close()
-
-        # Get already identified person_ids for this image
-        already_identified = set()
-        if image_id:
-            conn = sqlite3.connect(DB_PATH,timeout=10)
-
-            c = conn.cursor()
-            c.execute("SELECT person_id FROM matches WHERE image_id=?", (image_id,))
-            already_identified = set(pid[0] for pid in c.fetchall())
-            conn.close()
-
-        for idx, encoding in enumerate(unknown_encodings):
-            matches = face_recognition.compare_faces(known_encodings, encoding, tolerance=0.5)
-            for i, is_match in enumerate(matches):
-                person_id = known_person_ids[i]
-                if is_match and person_id not in already_identified:
-                    insert_match(image_id, person_id)
-                    return file_path
-    except Exception as e:
-        logging.error(f"Issue Processing {file_path}: {e}")
-    return None
-
-def worker_init(ppid):
-    process_name = f"face_worker_{os.getpid()}"
-    setproctitle.setproctitle(process_name)
-    pid = os.getpid()
+    def link_known_image(self, person_id, person_name, image_path):
+        """Job: detect the faces of a known image and match them against the library."""
+        new_matches = add_known_image_for_person(person_id, image_path)
+        self.post("status", f"Image linked to person '{person_name}'")
+        self.post("info", "Success", f"Image linked to person '{person_name}', {new_matches} new matching images found.")
+
+
+def reevaluate_matches(person_id, tolerance, output_folder=None):
+    """Re-evaluate the matches of a person at another tolerance from the stored scores.
+
+    Matched images are copied to output_folder when given. Returns the matched paths.
+    """
+    if tolerance > matching.SCORE_CUTOFF:
+        logging.warning(f"Tolerance {tolerance} above the stored score cutoff {matching.SCORE_CUTOFF}, "
+                        f"matches between the two are not known")
+    count = db.reevaluate_matches(person_id, tolerance)
+    file_paths = db.get_matched_paths(person_id)
+    logging.info(f"Person ID {person_id} matches {count} images at tolerance {tolerance}")
+    if output_folder:
+        os.makedirs(output_folder, exist_ok=True)
+        for file_path in file_paths:
+            output_file_path = utils.build_matches_file(file_path, output_folder)
+            if not os.path.exists(output_file_path) and os.path.exists(file_path):
+                shutil.copy(file_path, output_file_path)
+    return file_paths
+
+def find_similar_faces(image_path, k=10):
+    """Closest indexed faces to each face of an image, as {face_index: [(path, distance)]}."""
+    _, encodings, _ = pipeline.detect_faces(image_io.read_image(image_path)[0], **pipeline.encoder_options())
+    results = {}
+    for face_index, encoding in enumerate(encodings):
+        neighbours = ann_index.find_face(encoding, k)
+        paths = db.get_paths_for_image_ids({image_id for image_id, _, _ in neighbours})
+        results[face_index] = [(paths.get(image_id), distance) for image_id, _, distance in neighbours]
+    return results
 
 if __name__ == "__main__":
-    init_db()
+    parser = argparse.ArgumentParser(description="Face Recognition App")
+    parser.add_argument("--reevaluate", metavar="PERSON", help="re-evaluate the matches of a person from stored scores and exit")
+    parser.add_argument("--tolerance", type=float, help="tolerance used by --reevaluate (default: tolerance setting)")
+    parser.add_argument("--find", metavar="IMAGE", help="list the indexed faces closest to the faces of IMAGE and exit")
+    parser.add_argument("--reencode", action="store_true",
+                        help="recompute the encodings from the stored face boxes with the current encoding settings and exit")
+    args = parser.parse_args()
+
     config.initialize()
     utils.init_logging() 
     logging.info("Face Recognition App Starts")
+    db.init_db()
+    if args.reevaluate:
+        person_id = db.get_person_id(args.reevaluate)
+        if person_id is None:
+            sys.exit(f"Unknown person '{args.reevaluate}'")
+        tolerance = args.tolerance if args.tolerance is not None else config.TOLERANCE
+        file_paths = reevaluate_matches(person_id, tolerance, config.OUTPUT)
+        print(f"{len(file_paths)} images match '{args.reevaluate}' at tolerance {tolerance}")
+        sys.exit(0)
+    if args.find:
+        for face_index, neighbours in find_similar_faces(args.find).items():
+            print(f"Face {face_index}:")
+            for path, distance in neighbours:
+                print(f"  {distance:.3f}  {path}")
+        sys.exit(0)
+    if args.reencode:
+        print(f"{pipeline.reencode_library()} images re-encoded")
+        worker_pool.shutdown()
+        sys.exit(0)
     logging.info(f"Your computer have {os.cpu_count()} CPUs, configure workers accordingly")
+    # Started now so the models are loaded by the time the first scan runs
+    worker_pool.get_pool()
     app = FaceRecognitionApp()
     app.mainloop()
+    thumbnails.shutdown()
+    # The job has written its results by now, tasks left in the workers are dropped
+    worker_pool.shutdown(terminate=True)
     logging.info("Face Recognition App Exits")
\ No newline at end of file
@@ -0,0 +1,113 @@
+import os
+import io
+import logging
+import hashlib
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('jpg', 'jpeg', 'png')
+READ_BLOCK = 1024 * 1024
+
+def iter_image_files(folders):
+    """Yield the image files of each folder (not recursive) as they are listed."""
+    for folder in folders:
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.is_file():
+                        yield entry.path
+        except OSError as e:
+            logging.warning(f"Error accessing folder '{folder}': {e}")
+
+def file_stat(file_path):
+    """(size, mtime_ns, inode, device) used to detect unchanged files without reading them."""
+    st = os.stat(file_path)
+    return st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev
+
+def read_image(file_path, size=None):
+    """Read a file once into memory, hashing each block as it is read.
+
+    Returns (buffer, sha256 hex digest), the buffer is decoded with decode_reduced
+    so the file is never opened a second time.
+    """
+    hasher = hashlib.sha256()
+    if size is None:
+        size = os.path.getsize(file_path)
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    pos = 0
+    with open(file_path, "rb", buffering=0) as f:
+        while pos < size:
+            n = f.readinto(view[pos:pos + READ_BLOCK])
+            if not n:
+                break
+            hasher.update(view[pos:pos + n])
+            pos += n
+        # The file may have grown since it was stat'ed
+        rest = f.read()
+    view.release()
+    if pos < size:
+        del buffer[pos:]
+    if rest:
+        hasher.update(rest)
+        buffer += rest
+    return buffer, hasher.hexdigest()
+
+def decode_reduced(buffer, max_side, mode="RGB"):
+    """Decode an in-memory image file at reduced resolution for face detection.
+
+    JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale with Image.draft (DCT
+    scaling), other formats are reduced by an integer factor after decoding.
+    The decoded side stays between max_side and twice max_side.
+    Returns (array, (x_scale, y_scale)) to map coordinates back to the original.
+    """
+    with Image.open(io.BytesIO(buffer)) as image:
+        original_size = image.size
+        if max_side and max(original_size) > max_side:
+            ratio = max_side / max(original_size)
+            image.draft(mode, (int(original_size[0] * ratio + 0.5), int(original_size[1] * ratio + 0.5)))
+            image = image.convert(mode)
+            factor = max(image.size) // max_side
+            if factor > 1:
+                image = image.reduce(factor)
+        else:
+            image = image.convert(mode)
+        scale = (original_size[0] / image.width, original_size[1] / image.height)
+        return np.array(image), scale
+
+def scale_locations(locations, scale):
+    """Scale (top, right, bottom, left) face boxes, e.g. from a reduced decode back to original coordinates."""
+    x_scale, y_scale = scale
+    return [(int(round(top * y_scale)), int(round(right * x_scale)), int(round(bottom * y_scale)), int(round(left * x_scale)))
+            for top, right, bottom, left in locations]
+
+def scale_landmarks(landmarks, scale):
+    """Scale the (x, y) points of face_recognition landmark dicts like scale_locations."""
+    x_scale, y_scale = scale
+    return [{feature: [(int(round(x * x_scale)), int(round(y * y_scale))) for x, y in points]
+             for feature, points in face.items()} for face in landmarks]
+
+def perceptual_hash(buffer, hash_size=8):
+    """dHash of an in-memory image file, returns (hash, (width, height)).
+
+    The image is decoded tiny (JPEG DCT scaling), reduced to hash_size + 1 by
+    hash_size grey pixels and each bit tells whether a pixel is brighter than its
+    left neighbour. Resized or recompressed copies of a photo land a few bits apart.
+    The hash is a signed 64 bit integer so that SQLite can store it.
+    """
+    with Image.open(io.BytesIO(buffer)) as image:
+        size = image.size
+        image.draft("L", (hash_size * 8, hash_size * 8))
+        pixels = np.asarray(image.convert("L").resize((hash_size + 1, hash_size), Image.BOX), dtype=np.int16)
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int(bits.view(">i8")[0]), size
+
+def make_thumbnail(file_path, width):
+    """RGB thumbnail of an image file, width wide with its aspect ratio.
+
+    JPEGs are decoded straight at a reduced scale (Image.draft) before the final resize.
+    """
+    with Image.open(file_path) as image:
+        height = max(1, int(width * image.height / image.width))
+        image.draft("RGB", (width, height))
+        return image.convert("RGB").resize((width, height), Image.Resampling.LANCZOS)
@@ -0,0 +1,130 @@
+import os
+import time
+import socket
+import hashlib
+import logging
+import uuid
+
+import config
+import db
+
+# Paths listed or leased per transaction
+CHUNK_SIZE = 500
+# Longest wait between two looks at the leases of other runs
+POLL_SECONDS = 1.0
+
+def queue_name(kind, folders, encoder_id):
+    """Name of the queue of a scan, the same folders scanned with the same encoder share it."""
+    key = "\n".join([str(encoder_id)] + sorted(os.path.normcase(os.path.abspath(folder)) for folder in folders))
+    return f"{kind}:{hashlib.sha1(key.encode('utf-8')).hexdigest()}"
+
+class JobQueue:
+    """Durable queue of the files of one scan, kept in the jobs table of the database.
+
+    A file goes pending -> leased -> done, or back to pending with its error when
+    it fails, and to failed after max_attempts leases. Leases expire after
+    lease_seconds unless renewed, so that any number of runs, in this process or
+    others, can lease from the same queue and the files of a crashed run are taken
+    over by another one. The listing of the files is leased the same way. The queue
+    is deleted once all its files are done or failed, a run that ends while other
+    runs still hold files marks it complete so that the next scan lists the
+    folders again.
+    """
+
+    def __init__(self, name, lease_seconds=None, max_attempts=None):
+        self.name = name
+        self.lease_seconds = lease_seconds or config.JOB_LEASE_SECONDS
+        self.max_attempts = max_attempts or config.JOB_MAX_ATTEMPTS
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.renewed = time.monotonic()
+
+    def begin(self):
+        """Start, resume or join the scan of the queue. True when this run must list the files (see add, listed).
+
+        Only a scan that was cancelled or crashed is resumed with the files it left.
+        One whose files are being listed by another run is joined. Otherwise the files
+        are listed again: those still to do stay in the queue, new ones are added.
+        """
+        now = time.time()
+        with db.transaction():
+            listing = db.get_job_listing(self.name)
+            if listing is not None and listing[1] >= now:
+                logging.info(f"Joining the scan of {self.name}, its files are being listed")
+                return False
+            counts = db.count_jobs(self.name)
+            left = counts.get("pending", 0) + counts.get("leased", 0)
+            if listing is None and left and not counts.get("complete"):
+                logging.info(f"Resuming the interrupted scan of {self.name}, {left} files left")
+                return False
+            db.reset_jobs(self.name)
+            db.start_job_listing(self.name, self.owner, now + self.lease_seconds)
+        self.renewed = time.monotonic()
+        return True
+
+    def add(self, paths):
+        with db.transaction():
+            db.add_jobs(self.name, paths)
+
+    def listed(self):
+        with db.transaction():
+            db.end_job_listing(self.name, self.owner)
+
+    def lease(self, limit=CHUNK_SIZE):
+        now = time.time()
+        with db.transaction():
+            return db.lease_jobs(self.name, self.owner, limit, now, now + self.lease_seconds)
+
+    def renew(self):
+        """Extend the leases of this run, at most every third of lease_seconds."""
+        if time.monotonic() - self.renewed < self.lease_seconds / 3:
+            return
+        self.renewed = time.monotonic()
+        with db.transaction():
+            db.renew_jobs(self.name, self.owner, time.time() + self.lease_seconds)
+
+    def lease_wait(self):
+        """Seconds until a lease of another run expires (0 when one has), None when no other run holds any."""
+        expires = db.next_lease_expiry(self.name, self.owner)
+        return None if expires is None else max(0.0, expires - time.time())
+
+    def complete(self, paths):
+        """Mark leased files done, joins the caller's transaction."""
+        with db.transaction():
+            db.complete_jobs(self.name, self.owner, paths)
+
+    def fail(self, paths, error, retry=True):
+        """Put leased files back for another lease, or without retry mark them failed at once."""
+        with db.transaction():
+            db.fail_jobs(self.name, self.owner, paths, str(error), self.max_attempts if retry else 0)
+
+    def settle(self, cancelled):
+        """End of a run: files still leased go back to pending when it was cancelled, otherwise they failed.
+
+        Returns the number of files left for the next run.
+        """
+        with db.transaction():
+            if cancelled:
+                db.release_jobs(self.name, self.owner)
+            interrupted = db.end_job_listing(self.name, self.owner)
+        if not cancelled:
+            leased = db.get_leased_jobs(self.name, self.owner)
+            if leased:
+                logging.warning(f"{len(leased)} files of {self.name} were not completed")
+                self.fail(leased, "Not completed")
+        counts = db.count_jobs(self.name)
+        left = counts.get("pending", 0) + counts.get("leased", 0) + counts.get("listing", 0)
+        if left and not interrupted:
+            if not cancelled:
+                # Held by other runs, or failed with tries left: the next scan lists the folders again
+                with db.transaction():
+                    db.mark_jobs_complete(self.name)
+            logging.info(f"{left} files of {self.name} left for the next run")
+            return left
+        for path, attempts, error in db.get_failed_jobs(self.name):
+            logging.warning(f"Left out {path}: {error}")
+        if counts.get("failed"):
+            logging.warning(f"{counts['failed']} files of {self.name} failed")
+        # Not all the files of an interrupted listing are in the queue, the next scan starts over
+        with db.transaction():
+            db.delete_jobs(self.name)
+        return 0
@@ -0,0 +1,163 @@
+import logging
+import numpy as np
+
+import db
+import encoding_store
+
+DEFAULT_TOLERANCE = 0.5
+# Scores above this distance are not stored, no sane tolerance goes that far
+SCORE_CUTOFF = 0.8
+
+class MatchingEngine:
+    """Known person encodings kept resident as one float32 matrix.
+
+    A chunk of unknown faces is compared with a single distance matrix against
+    every known encoding, the best distance is kept per (face, person) and every
+    person under tolerance is reported, not only the first one.
+    """
+
+    def __init__(self, known_encodings, known_person_ids, tolerance=DEFAULT_TOLERANCE):
+        known = np.asarray(known_encodings, dtype=np.float32)
+        known = known.reshape(-1, known.shape[-1] if known.size else encoding_store.ENCODING_DIM)
+        person_ids = np.asarray(known_person_ids, dtype=np.int64)
+        # Columns grouped by person so the per-person minimum is one reduceat
+        order = np.argsort(person_ids, kind="stable")
+        self.known = np.ascontiguousarray(known[order])
+        self.known_sq = np.einsum("ij,ij->i", self.known, self.known)
+        self.person_ids, self.person_starts = np.unique(person_ids[order], return_index=True)
+        self.tolerance = tolerance
+
+    @classmethod
+    def from_db(cls, tolerance=DEFAULT_TOLERANCE, store=None):
+        known_encodings, known_person_ids = load_known_encodings(store)
+        return cls(known_encodings, known_person_ids, tolerance)
+
+    def __len__(self):
+        return len(self.known)
+
+    def distances(self, encodings):
+        """Euclidean distance matrix (faces x known encodings)."""
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, self.known.shape[1])
+        sq = np.einsum("ij,ij->i", encodings, encodings)
+        d2 = sq[:, None] + self.known_sq[None, :] - 2.0 * (encodings @ self.known.T)
+        np.maximum(d2, 0.0, out=d2)
+        return np.sqrt(d2, out=d2)
+
+    def person_distances(self, encodings):
+        """Best distance of every face to every person (faces x persons)."""
+        if len(self) == 0 or len(encodings) == 0:
+            return np.empty((len(encodings), len(self.person_ids)), dtype=np.float32)
+        return np.minimum.reduceat(self.distances(encodings), self.person_starts, axis=1)
+
+    def match(self, encodings, tolerance=None):
+        """(face rows, person ids, distances) of every face/person pair under tolerance."""
+        tolerance = self.tolerance if tolerance is None else tolerance
+        dist = self.person_distances(encodings)
+        rows, cols = np.nonzero(dist <= tolerance)
+        return rows, self.person_ids[cols], dist[rows, cols]
+
+    def scores(self, image_ids, face_indexes, encodings, cutoff=SCORE_CUTOFF):
+        """(image_id, face_index, person_id, distance) of every face/person pair under cutoff.
+
+        The cutoff is looser than the tolerance so that the stored scores can be
+        re-evaluated later at another tolerance without touching the images.
+        """
+        if len(self) == 0 or len(encodings) == 0:
+            return []
+        rows, person_ids, distances = self.match(encodings, cutoff)
+        image_ids = np.asarray(image_ids, dtype=np.int64)[rows]
+        face_indexes = np.asarray(face_indexes, dtype=np.int64)[rows]
+        return list(zip(image_ids.tolist(), face_indexes.tolist(), person_ids.tolist(), distances.tolist()))
+
+def best_matches(scores, tolerance):
+    """Reduce scores to {image_id: {person_id: best distance}} under tolerance."""
+    matched = {}
+    for image_id, _, person_id, distance in scores:
+        if distance > tolerance:
+            continue
+        persons = matched.setdefault(image_id, {})
+        if distance < persons.get(person_id, np.inf):
+            persons[person_id] = distance
+    return matched
+
+def match_paths(file_paths, engine, store=None):
+    """Match indexed images from their stored encodings and record the scores and matches.
+
+    Returns the matched file paths.
+    """
+    image_ids = db.get_image_ids_for_paths(file_paths)
+    owners, face_indexes, encodings = load_image_encodings(set(image_ids.values()), store)
+    scores = engine.scores(owners, face_indexes, encodings)
+    matched = best_matches(scores, engine.tolerance)
+    with db.transaction():
+        db.insert_match_scores(scores)
+        for image_id, persons in matched.items():
+            for person_id, distance in persons.items():
+                db.insert_match(image_id, person_id, distance)
+    return [file_path for file_path in file_paths if image_ids.get(file_path) in matched]
+
+def scan_store(engine, cutoff=SCORE_CUTOFF, chunk_rows=65536, store=None):
+    """Scores of every encoding already in the store (default: current encoder) against the engine, no image is decoded.
+
+    The memory-mapped matrix is walked in chunks so memory stays bounded on large libraries.
+    """
+    if store is None:
+        store = encoding_store.get_store()
+    row_image_ids, row_face_indexes = encoding_store.load_row_owners(store)
+    matrix = store.matrix()[:len(row_image_ids)]
+    scores = []
+    for start in range(0, len(matrix), chunk_rows):
+        owners = row_image_ids[start:start + chunk_rows]
+        referenced = owners >= 0
+        if not referenced.any():
+            continue
+        encodings = np.asarray(matrix[start:start + chunk_rows], dtype=np.float32)[referenced]
+        scores.extend(engine.scores(owners[referenced], row_face_indexes[start:start + chunk_rows][referenced],
+                                    encodings, cutoff))
+    return scores
+
+def load_known_encodings(store=None):
+    """Encodings of the images linked to persons in a store (default: current encoder), with the person id of each row."""
+    known_encodings = np.empty((0, encoding_store.ENCODING_DIM), dtype=np.float32)
+    known_person_ids = []
+    try:
+        if store is None:
+            store = encoding_store.get_store()
+        c = db.get_connection().cursor()
+        # Get all persons and their known images
+        c.execute("""
+            SELECT persons.id, image_encodings.store_row
+            FROM known_images
+            JOIN persons ON known_images.person_id = persons.id
+            JOIN image_encodings ON known_images.image_id = image_encodings.image_id
+            WHERE image_encodings.encoder_id=?
+        """, (store.encoder_id,))
+        rows = c.fetchall()
+        if rows:
+            known_person_ids = [person_id for person_id, _ in rows]
+            known_encodings = store.get([store_row for _, store_row in rows])
+    except Exception as e:
+        logging.error(f"SQLite error in load_known_encodings: {e}")
+    if not known_person_ids:
+        logging.error("No valid face encodings found in known_images/image_encodings tables!")
+    logging.debug(f"Loaded {len(known_person_ids)} known encodings for persons {sorted(set(known_person_ids))}")
+    return known_encodings, known_person_ids
+
+def load_image_encodings(image_ids, store=None):
+    """Stored encodings of the given images, returns (image_id per row, face_index per row, encodings)."""
+    if store is None:
+        store = encoding_store.get_store()
+    image_ids = list(image_ids)
+    owners, face_indexes, store_rows = [], [], []
+    c = db.get_connection().cursor()
+    for i in range(0, len(image_ids), 500):
+        chunk = image_ids[i:i + 500]
+        c.execute(
+            "SELECT image_id, face_index, store_row FROM image_encodings "
+            f"WHERE encoder_id=? AND image_id IN ({','.join('?' * len(chunk))}) ORDER BY image_id, face_index",
+            (store.encoder_id, *chunk))
+        for image_id, face_index, store_row in c.fetchall():
+            owners.append(image_id)
+            face_indexes.append(face_index)
+            store_rows.append(store_row)
+    return owners, face_indexes, store.get(store_rows)
@@ -0,0 +1,119 @@
+import logging
+import threading
+
+import db
+import image_io
+
+# Copies whose width/height ratios differ more than this are crops, not resizes
+ASPECT_TOLERANCE = 0.02
+MASK = (1 << 64) - 1
+
+_indexes = {}
+_index_lock = threading.Lock()
+
+def hamming(a, b):
+    return ((a ^ b) & MASK).bit_count()
+
+class BKTree:
+    """Burkhard-Keller tree of 64 bit perceptual hashes under the Hamming distance.
+
+    Each node keeps its children by their distance to it. By the triangle
+    inequality a search within radius r of a query at distance d of a node only
+    descends the children at distance d - r to d + r.
+    """
+
+    def __init__(self):
+        # node: [hash, values, {distance: child}]
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, key, value):
+        self.size += 1
+        if self.root is None:
+            self.root = [key, [value], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(key, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, [value], {}]
+                return
+            node = child
+
+    def search(self, key, radius):
+        """[(distance, value)] of the hashes within radius of key, closest first."""
+        found = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = hamming(key, node[0])
+            if distance <= radius:
+                found.extend((distance, value) for value in node[1])
+            nodes.extend(child for edge, child in node[2].items() if distance - radius <= edge <= distance + radius)
+        found.sort(key=lambda item: item[0])
+        return found
+
+class NearDuplicateIndex:
+    """Perceptual hashes of the indexed images, values are (content hash, (width, height))."""
+
+    def __init__(self):
+        self.tree = BKTree()
+        self.hashes = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls):
+        index = cls()
+        for hash_val, phash, width, height in db.iter_perceptual_hashes():
+            index.add(hash_val, (phash, (width, height)))
+        logging.info(f"Loaded {len(index.tree)} perceptual hashes")
+        return index
+
+    def add(self, hash_val, signature):
+        phash, size = signature
+        with self.lock:
+            # Written images may already be there when the index was loaded in their transaction
+            if hash_val not in self.hashes:
+                self.hashes.add(hash_val)
+                self.tree.add(phash, (hash_val, size))
+
+    def find(self, signature, max_distance):
+        """Images of the same shot as signature, as [(distance, content hash, (width, height))] closest first.
+
+        Only copies with the same aspect ratio are returned, so their face boxes
+        map onto the image by scaling.
+        """
+        phash, (width, height) = signature
+        with self.lock:
+            found = self.tree.search(phash, max_distance)
+        return [(distance, hash_val, size) for distance, (hash_val, size) in found
+                if size[0] and size[1] and abs(width / height - size[0] / size[1]) <= ASPECT_TOLERANCE * width / height]
+
+def get_index():
+    """Near duplicate index of the current database, loaded on first use."""
+    with _index_lock:
+        index = _indexes.get(db.DB_PATH)
+        if index is None:
+            index = _indexes[db.DB_PATH] = NearDuplicateIndex.load()
+        return index
+
+def find_locations(signature, detector, max_distance):
+    """Face boxes of the closest near duplicate detected with detector, scaled to the image of signature.
+
+    Returns (content hash of the copy, locations), or None when the detector has
+    run on no copy within max_distance bits. Boxes a copy took from another one
+    are not passed on.
+    """
+    width, height = signature[1]
+    for _, hash_val, (copy_width, copy_height) in get_index().find(signature, max_distance):
+        locations = db.get_face_locations(hash_val, detector)
+        if locations is not None:
+            return hash_val, image_io.scale_locations(locations, (width / copy_width, height / copy_height))
+    return None
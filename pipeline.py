@@ -0,0 +1,774 @@
+import os, time
+import shutil
+import logging, traceback
+import threading
+from queue import Queue, Empty
+from multiprocessing import TimeoutError as PoolTimeoutError
+from pathlib import Path
+from functools import partial
+from collections import deque, namedtuple
+import numpy as np
+from PIL import UnidentifiedImageError
+import dlib
+import face_recognition
+
+import config, utils
+import db
+import image_io
+import matching
+import encoders
+import encoding_store
+import deepface_search
+import near_duplicates
+import worker_pool
+import cancellation
+import jobs
+
+# Bounds of the queues between stages, they are what keeps memory flat:
+# a stage blocks on put() when the next one falls behind
+PATH_QUEUE_SIZE = 1000
+ENCODE_QUEUE_PER_WORKER = 2
+# Seconds between two on_progress calls
+PROGRESS_INTERVAL = 0.5
+# Seconds a blocking wait lasts before checking the cancel token again
+CANCEL_POLL = 0.1
+# Seconds between two tries of a file that failed to read or export, in resumable scans
+RETRY_DELAY = 1.0
+
+# Messages of the feed stage to the encode stage, next to the aligned faces
+FeedDone = namedtuple("FeedDone", "submitted")
+AlignFailed = namedtuple("AlignFailed", "path hash error")
+
+def throttled(iterable, semaphore, cancel):
+    """Yield from iterable once a slot is free, so pending pool tasks stay bounded."""
+    for item in iterable:
+        while not semaphore.acquire(timeout=CANCEL_POLL):
+            if cancel.cancelled:
+                return
+        if cancel.cancelled:
+            return
+        yield item
+
+def until_cancelled(results, cancel):
+    """Yield the results of a pool imap iterator until they run out or cancel is set."""
+    while not cancel.cancelled:
+        try:
+            yield results.next(timeout=CANCEL_POLL)
+        except PoolTimeoutError:
+            continue
+        except StopIteration:
+            return
+
+def read_file(img, paranoid=False, encoder_id=None, detector=None):
+    """Read stage: stat the file and read it only when it may have changed.
+
+    A file whose size, mtime and inode match the last scan keeps its cached hash
+    and is not read at all, unless paranoid is set or the encoder has not encoded
+    it yet. A file whose content is already encoded, under any path, is only mapped
+    to the existing image. Returns one of
+      ("indexed", (path, num_faces))                     nothing to write
+      ("record", record)                                 known content, record for the DB writer
+      ("encode", (path, buffer, hash, stat, locations, signature, derived))
+                                                         content for the encode stage, locations
+                                                         are the stored boxes of the detector or None
+    A new content within config.NEAR_DUPLICATE_DISTANCE bits of the perceptual hash
+    (signature) of a detected image takes its boxes scaled to its size, derived is
+    then set so that they are not stored as boxes found by the detector.
+    """
+    formatted_path = str(Path(img))
+    stat = image_io.file_stat(img)
+    try:
+        row = db.get_file_state(formatted_path, encoder_id)
+    except Exception as e:
+        logging.warning(f"Database error for {img}: {e}")
+        row = None
+
+    unchanged = row is not None and row[:4] == stat
+    if unchanged and row[5] is not None and not paranoid:
+        logging.debug(f"Image queued: {img} (unchanged, no re-hashing)")
+        return "indexed", (formatted_path, row[5])
+
+    # The file is read once, the same buffer is hashed and decoded
+    buffer, hash_val = image_io.read_image(img, stat[0])
+    num_faces = row[5] if row and row[4] == hash_val else None
+    if num_faces is None:
+        try:
+            num_faces = db.get_num_faces(hash_val, encoder_id)
+        except Exception as e:
+            logging.warning(f"Database error for {img}: {e}")
+    if num_faces is not None:
+        logging.info(f"Image queued: {img} (existing hash, no re-encoding)")
+        return "record", db.Record(formatted_path, hash_val, num_faces, None, stat)
+    if unchanged and row[4] != hash_val:
+        logging.warning(f"Image {img} changed without any change of size or mtime")
+    locations = None
+    derived = False
+    if detector:
+        try:
+            locations = db.get_face_locations(hash_val, detector)
+        except Exception as e:
+            logging.warning(f"Database error for {img}: {e}")
+    try:
+        signature = image_io.perceptual_hash(buffer)
+    except Exception as e:
+        logging.warning(f"Error hashing image {img}: {e}")
+        signature = None
+    if locations is None and detector and signature and config.NEAR_DUPLICATE_DISTANCE >= 0:
+        try:
+            near = near_duplicates.find_locations(signature, detector, config.NEAR_DUPLICATE_DISTANCE)
+        except Exception as e:
+            logging.warning(f"Database error for {img}: {e}")
+            near = None
+        if near is not None:
+            logging.info(f"Image {img} is a near duplicate of {near[0]}, reusing its {len(near[1])} face boxes")
+            locations = near[1]
+            derived = True
+    return "encode", (formatted_path, buffer, hash_val, stat, locations, signature, derived)
+
+def encoder_options():
+    """Decoding and encoding settings, passed explicitly since spawned workers do not load the config."""
+    return {"max_side": config.MAX_DETECTION_SIDE, "model": config.ENCODING_MODEL, "jitters": config.ENCODING_JITTERS}
+
+def align_faces(image, locations, model="small"):
+    """Aligned 150x150 face chips at the given boxes of a decoded image, as face_encodings crops them."""
+    shapes = face_recognition.api._raw_face_landmarks(image, locations, model)
+    return [dlib.get_face_chip(image, shape, size=150, padding=0.25) for shape in shapes]
+
+def embed_chips(chips, jitters=1):
+    """Encodings of aligned face chips, in one call of the embedding model."""
+    if not chips:
+        return []
+    return [np.array(descriptor) for descriptor in face_recognition.api.face_encoder.compute_face_descriptor(chips, jitters)]
+
+def detect_and_align(buffer, locations=None, max_side=None, model="small", landmarks=False):
+    """Decode an image, detect its faces unless their boxes are known, and crop the aligned faces.
+
+    Returns (locations, chips, landmarks) with boxes and landmarks in original image coordinates.
+    """
+    image, scale = image_io.decode_reduced(buffer, max_side)
+    if locations is None:
+        locations = face_recognition.face_locations(image)
+    else:
+        # Crop from the same reduced decode the boxes were detected on
+        locations = image_io.scale_locations(locations, (1 / scale[0], 1 / scale[1]))
+    points = None
+    if landmarks:
+        points = image_io.scale_landmarks(face_recognition.face_landmarks(image, locations, model), scale)
+    return image_io.scale_locations(locations, scale), align_faces(image, locations, model), points
+
+def detect_faces(buffer, max_side=None, model="small", jitters=1, landmarks=False):
+    """Detect and encode the faces of an in-memory image file.
+
+    Detection runs on a reduced decode (see image_io.decode_reduced), the returned
+    face boxes are (top, right, bottom, left) in original image coordinates.
+    Returns (locations, encodings, landmarks), landmarks is None unless asked for.
+    """
+    locations, chips, points = detect_and_align(buffer, None, max_side, model, landmarks)
+    return locations, embed_chips(chips, jitters), points
+
+def encode_faces(buffer, locations, max_side=None, model="small", jitters=1):
+    """Encode the faces at known boxes (original coordinates) of an in-memory image, without detection."""
+    return embed_chips(detect_and_align(buffer, locations, max_side, model)[1], jitters)
+
+def align_buffer(task, encoder=None, max_side=None, model="small", landmarks=False):
+    """First half of the encode stage, runs in the worker processes: detect and align the faces of one buffer.
+
+    Faces with stored boxes are only aligned. Returns (path, hash, stat, locations,
+    landmarks, signature, derived, faces), faces are the model inputs embedded in batches by embed_faces.
+    """
+    path, buffer, hash_val, stat, locations, signature, derived = task
+    points = None
+    try:
+        if encoder is not None and encoders.is_deepface(encoder):
+            locations, faces = deepface_search.align(buffer, encoder, max_side)
+            derived = False
+        else:
+            locations, faces, points = detect_and_align(buffer, locations, max_side, model, landmarks)
+    except Exception as e:
+        logging.warning(f"Error encoding image {path}: {e}")
+        locations, faces, derived = [], [], False
+    return path, hash_val, stat, locations, points, signature, derived, faces
+
+def embed_faces(faces, encoder=None, jitters=1):
+    """Second half of the encode stage, runs in the worker processes: embed a batch of aligned faces."""
+    if encoder is not None and encoders.is_deepface(encoder):
+        return deepface_search.embed(faces, encoder)
+    return embed_chips(faces, jitters)
+
+class FaceBatcher:
+    """Gathers the aligned faces of many images into batches of the embedding model.
+
+    Each batch is embedded by one pool task, at most max_pending at a time. An image
+    is emitted as a Record once all its faces are embedded, images whose batch fails
+    are dropped, and passed to drop, so that the next scan encodes them again.
+    Waiting for a batch raises cancellation.Cancelled once cancel is set, the
+    images still in the batcher are then left for the next scan.
+    """
+
+    def __init__(self, pool, embed, batch_size, max_pending, emit, drop=None, cancel=None):
+        self.pool = pool
+        self.embed = embed
+        self.batch_size = max(1, batch_size)
+        self.max_pending = max(1, max_pending)
+        self.emit = emit
+        self.drop = drop
+        self.cancel = cancel or cancellation.CancelToken()
+        # key -> {"info": (path, hash, stat, locations, landmarks, signature, derived), "encodings": [...], "left": faces left}
+        self.images = {}
+        self.next_key = 0
+        self.faces = []
+        self.running = deque()
+
+    def add(self, aligned):
+        path, hash_val, stat, locations, points, signature, derived, faces = aligned
+        if not faces:
+            self.emit(db.Record(path, hash_val, 0, [], stat, locations, points, signature, derived))
+            return
+        key = self.next_key
+        self.next_key += 1
+        self.images[key] = {"info": (path, hash_val, stat, locations, points, signature, derived),
+                            "encodings": [None] * len(faces), "left": len(faces)}
+        self.faces.extend((key, face_index, face) for face_index, face in enumerate(faces))
+        while len(self.faces) >= self.batch_size:
+            self.submit(self.faces[:self.batch_size])
+            del self.faces[:self.batch_size]
+        while self.running and self.running[0][0].ready():
+            self.collect()
+
+    def submit(self, faces):
+        while len(self.running) >= self.max_pending:
+            self.collect()
+        result = self.pool.apply_async(self.embed, ([face for _, _, face in faces],))
+        self.running.append((result, [(key, face_index) for key, face_index, _ in faces]))
+
+    def collect(self):
+        result, owners = self.running[0]
+        while not result.ready():
+            self.cancel.check()
+            result.wait(CANCEL_POLL)
+        self.running.popleft()
+        try:
+            encodings = result.get()
+        except Exception as e:
+            logging.error(f"Error embedding a batch of {len(owners)} faces: {e}")
+            encodings = None
+        for (key, face_index), encoding in zip(owners, encodings if encodings is not None else [None] * len(owners)):
+            image = self.images.get(key)
+            if image is None:
+                continue
+            if encoding is None:
+                logging.warning(f"Image {image['info'][0]} not encoded, it will be retried")
+                del self.images[key]
+                if self.drop:
+                    self.drop(image["info"][1])
+                continue
+            image["encodings"][face_index] = encoding
+            image["left"] -= 1
+            if image["left"] == 0:
+                del self.images[key]
+                path, hash_val, stat, locations, points, signature, derived = image["info"]
+                logging.info(f"Image queued: {path} (encoded, new hash)")
+                self.emit(db.Record(path, hash_val, len(image["encodings"]), image["encodings"], stat, locations, points,
+                                    signature, derived))
+
+    def close(self):
+        """Embed the last partial batch and wait for every pending one."""
+        if self.faces:
+            self.submit(self.faces)
+            self.faces = []
+        while self.running:
+            self.collect()
+
+def reencode_image(task, max_side=None, model="small", jitters=1):
+    """Re-encode worker: read an indexed image and encode it from its stored boxes.
+
+    Returns (image_id, encodings), encodings is None when the file is unreadable
+    or its content no longer matches the indexed hash.
+    """
+    image_id, hash_val, path, locations = task
+    try:
+        buffer, current_hash = image_io.read_image(path)
+        if current_hash != hash_val:
+            logging.warning(f"Image {path} changed since it was indexed, not re-encoded")
+            return image_id, None
+        return image_id, encode_faces(buffer, locations, max_side, model, jitters)
+    except Exception as e:
+        logging.warning(f"Error re-encoding image {path}: {e}")
+        return image_id, None
+
+def reencode_library(workers=None, cancel=None):
+    """Encode every image with stored boxes that the current encoder has not encoded, skipping face detection.
+
+    Used after changing the encoding settings, only the embedding step runs. The
+    encodings of the previous settings stay cached under their own encoder.
+    Images the detector found no face in are only marked encoded. Images indexed
+    before boxes were stored, or whose boxes came from a near duplicate, are not
+    re-encoded, the next scan encodes them. Stops early when cancel is set,
+    what was encoded is written. Returns the number of images re-encoded.
+    """
+    workers = workers or config.WORKERS
+    # Also stopped on errors, so that the pool's task thread is never left waiting in throttled
+    stop = cancellation.CancelToken(cancel)
+    encoder = encoders.current_encoder()
+    encoder_id = encoders.get_id(encoder)
+    writer = db.DBWriter(config.DB_BATCH_SIZE, config.DB_FLUSH_MS / 1000,
+                         write=partial(db.write_encodings, encoder_id=encoder_id), encoder_id=encoder_id)
+    pending = threading.Semaphore(workers * ENCODE_QUEUE_PER_WORKER)
+    start = time.perf_counter()
+    reencoded = 0
+    faceless = 0
+
+    def tasks():
+        # Images without any face have nothing to embed, they go straight to the writer
+        nonlocal faceless
+        for chunk in db.iter_face_locations(encoder.detector, encoder_id):
+            for task in chunk:
+                if task[3]:
+                    yield task
+                else:
+                    writer.put((task[0], []))
+                    faceless += 1
+
+    writer.start()
+    try:
+        with worker_pool.get_pool().use() as pool:
+            results = pool.imap_unordered(partial(reencode_image, **encoder_options()), throttled(tasks(), pending, stop))
+            for image_id, encodings in until_cancelled(results, stop):
+                pending.release()
+                if encodings is not None:
+                    writer.put((image_id, encodings))
+                    reencoded += 1
+    except Exception as e:
+        logging.error(f"Error re-encoding the library: {e}")
+        logging.debug(traceback.format_exc())
+    finally:
+        stop.cancel()
+        writer.close()
+    logging.info(f"Re-encoded {reencoded} images in {time.perf_counter() - start:.1f}s, {faceless} without faces marked encoded")
+    return reencoded
+
+class Pipeline:
+    """Staged scan -> read -> detect/encode -> match/write -> export pipeline.
+
+    Each stage has its own workers and talks to the next through a bounded queue:
+      scan      one thread listing the folders
+      read      read_threads I/O threads (stat, hash, read the buffer)
+      encode    the shared worker pool (worker_pool) running detection and alignment, the
+                aligned faces of many images are embedded in batches (FaceBatcher)
+      store     the single DBWriter thread, writes the batch then matches it
+                with the resident MatchingEngine in the same transaction
+      export    one thread copying the matched files to the output folder
+    Without an engine the pipeline only indexes the images. Images are encoded
+    with the encoder (default: current face_recognition settings) unless it has
+    already encoded their content, the engine must hold encodings of that encoder.
+    Paths with the same content are encoded once: the first one read goes to the
+    encode stage, the others wait for its record and are mapped to its image.
+    on_progress(snapshot) is called from the thread running run() every
+    PROGRESS_INTERVAL seconds and once at the end, see progress().
+    Once cancel (a cancellation.CancelToken) is set the stages stop taking new
+    files within about CANCEL_POLL seconds. The records already produced are still
+    written and their matches exported, files in flight are left for the next scan.
+    With resumable the files go through a durable jobs.JobQueue: a scan that was
+    interrupted, even by a crash, resumes with the files it had not completed
+    instead of listing the folders again, and runs scanning the same folders share
+    the work. A file is done once its record is written, or its copy exported when
+    it matched. A file that fails is tried again within the run, see retried().
+    """
+
+    def __init__(self, folders, engine=None, output_folder=None, workers=None, read_threads=None,
+                 paranoid=None, on_queued=None, on_match=None, encoder=None, on_progress=None, cancel=None,
+                 resumable=False):
+        self.folders = list(folders)
+        self.engine = engine
+        self.output_folder = output_folder
+        self.workers = workers or config.WORKERS
+        self.read_threads = read_threads or config.READ_THREADS
+        self.paranoid = config.PARANOID_RESCAN if paranoid is None else paranoid
+        self.encoder = encoder or encoders.current_encoder()
+        self.encoder_options = dict(encoder_options(), encoder=self.encoder, landmarks=config.STORE_LANDMARKS)
+        self.batch_size = config.ENCODE_BATCH_SIZE
+        self.encoder_id = encoders.get_id(self.encoder)
+        # Stored boxes are only reused by face_recognition, DeepFace crops with its own detector
+        self.detector = None if encoders.is_deepface(self.encoder) else self.encoder.detector
+        self.on_queued = on_queued
+        self.on_match = on_match
+        self.on_progress = on_progress
+        self.cancel = cancel or cancellation.CancelToken()
+        self.jobs = None
+        if resumable:
+            self.jobs = jobs.JobQueue(jobs.queue_name("match" if engine else "index", self.folders, self.encoder_id))
+        self.start_time = None
+        self.scan_done = threading.Event()
+
+        self.paths = Queue(maxsize=PATH_QUEUE_SIZE)
+        self.to_encode = Queue(maxsize=self.workers * ENCODE_QUEUE_PER_WORKER)
+        # Not bounded: the writer fills it and must never wait on the export stage, which reports
+        # back through the writer. It only holds the matched paths not copied yet.
+        self.to_export = Queue()
+        self.writer = db.DBWriter(config.DB_BATCH_SIZE, config.DB_FLUSH_MS / 1000, write=self.store_batch,
+                                  encoder_id=self.encoder_id, index=not encoders.is_deepface(self.encoder),
+                                  committed=self.export_committed)
+        # Matched paths of the batch being written, exported once it is committed
+        self.matched = []
+
+        self.stats_lock = threading.Lock()
+        self.stats = {"scanned": 0, "read": 0, "unchanged": 0, "duplicates": 0, "encoded": 0, "written": 0,
+                      "queued": 0, "matched": 0, "exported": 0}
+        # hash being encoded -> [(path, stat)] of the other paths with that content
+        self.in_flight = {}
+        self.readers_left = self.read_threads
+        self.encode_input_done = threading.Event()
+
+    def count(self, name, n=1):
+        with self.stats_lock:
+            self.stats[name] += n
+
+    def progress(self):
+        """Snapshot of the stage counters with elapsed seconds, images/sec, fraction done and ETA seconds.
+
+        Until the scan is over the total is the number of files listed so far,
+        fraction and eta are None while nothing has been read.
+        """
+        with self.stats_lock:
+            snapshot = dict(self.stats)
+        elapsed = time.perf_counter() - self.start_time if self.start_time else 0.0
+        done = snapshot["read"]
+        rate = done / elapsed if elapsed > 0 else 0.0
+        snapshot.update(elapsed=elapsed, rate=rate, scan_done=self.scan_done.is_set(),
+                        fraction=done / snapshot["scanned"] if snapshot["scanned"] else None,
+                        eta=(snapshot["scanned"] - done) / rate if rate > 0 else None)
+        return snapshot
+
+    def report_progress(self):
+        if self.on_progress:
+            try:
+                self.on_progress(self.progress())
+            except Exception as e:
+                logging.error(f"Error reporting progress: {e}")
+
+    def run(self):
+        start = time.perf_counter()
+        self.start_time = start
+        # Started before the stage threads: workers forked while one of them holds a lock could hang
+        worker_pool.get_pool()
+        self.writer.start()
+        threads = [threading.Thread(target=self.scan_stage, name="Scan", daemon=True)]
+        threads += [threading.Thread(target=self.read_stage, name=f"Read-{i}", daemon=True) for i in range(self.read_threads)]
+        threads += [threading.Thread(target=self.encode_stage, name="Encode", daemon=True)]
+        export_thread = threading.Thread(target=self.export_stage, name="Export", daemon=True)
+        export_thread.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(PROGRESS_INTERVAL)
+                self.report_progress()
+                self.renew_jobs()
+        # Every item has reached the writer once the read and encode stages are done. The matches
+        # of its last batch are exported, then the writer stores the outcome of the exports.
+        self.writer.sync()
+        self.to_export.put(None)
+        export_thread.join()
+        self.writer.close()
+        if self.jobs is not None:
+            try:
+                self.jobs.settle(self.cancel.cancelled)
+            except Exception as e:
+                logging.error(f"Error updating the job queue: {e}")
+        self.report_progress()
+        logging.info(f"Pipeline finished in {time.perf_counter() - start:.1f}s: {self.stats}")
+        return self.stats
+
+    def renew_jobs(self):
+        if self.jobs is not None:
+            try:
+                self.jobs.renew()
+            except Exception as e:
+                logging.error(f"Error renewing job leases: {e}")
+
+    def scan_stage(self):
+        try:
+            if self.jobs is not None:
+                self.scan_jobs()
+            else:
+                for path in image_io.iter_image_files(self.folders):
+                    if self.cancel.cancelled:
+                        break
+                    self.paths.put(path)
+                    self.count("scanned")
+        except Exception as e:
+            logging.error(f"Error in scan stage: {e}")
+            logging.debug(traceback.format_exc())
+        finally:
+            if self.jobs is not None:
+                db.close_connection()
+            self.scan_done.set()
+            for _ in range(self.read_threads):
+                self.paths.put(None)
+
+    def scan_jobs(self):
+        """Scan through the job queue: list the folders into it unless resuming, and lease until it is empty."""
+        listing = self.jobs.begin()
+        while not self.cancel.cancelled:
+            if listing:
+                self.list_jobs()
+                listing = False
+                continue
+            if self.put_leased():
+                continue
+            # Files leased by another run are waited for, they are taken over if that run dies
+            wait = self.jobs.lease_wait()
+            if wait is None:
+                return
+            if wait == 0:
+                listing = self.jobs.begin()
+                continue
+            deadline = time.monotonic() + min(wait, jobs.POLL_SECONDS)
+            while time.monotonic() < deadline and not self.cancel.cancelled:
+                time.sleep(CANCEL_POLL)
+
+    def list_jobs(self):
+        listed = []
+        for path in image_io.iter_image_files(self.folders):
+            if self.cancel.cancelled:
+                return
+            listed.append(str(Path(path)))
+            if len(listed) == jobs.CHUNK_SIZE:
+                self.jobs.add(listed)
+                listed = []
+                # Leased as they are listed, so that reading starts with the first folder
+                self.put_leased()
+        self.jobs.add(listed)
+        self.jobs.listed()
+
+    def put_leased(self):
+        paths = self.jobs.lease()
+        for path in paths:
+            if self.cancel.cancelled:
+                break
+            self.paths.put(path)
+            self.count("scanned")
+        return len(paths)
+
+    def read_stage(self):
+        try:
+            for path in iter(self.paths.get, None):
+                if self.cancel.cancelled:
+                    continue
+                try:
+                    kind, item = self.retried(partial(read_file, path, self.paranoid, self.encoder_id, self.detector), path)
+                except Exception as e:
+                    logging.warning(f"Error processing image {path}: {e}")
+                    self.fail_job(path, e)
+                    continue
+                self.count("read")
+                if kind == "encode":
+                    if self.claim(item):
+                        self.to_encode.put(item)
+                else:
+                    if kind == "indexed":
+                        self.count("unchanged")
+                    self.writer.put((kind, item))
+        finally:
+            db.close_connection()
+            with self.stats_lock:
+                self.readers_left -= 1
+                last = self.readers_left == 0
+            if last:
+                self.to_encode.put(None)
+
+    def retried(self, call, path):
+        """Return call(), tried up to JOB_MAX_ATTEMPTS times in resumable scans: their errors are often transient."""
+        attempts = self.jobs.max_attempts if self.jobs is not None else 1
+        for attempt in range(1, attempts + 1):
+            try:
+                return call()
+            except UnidentifiedImageError:
+                raise
+            except Exception as e:
+                if attempt == attempts or self.cancel.cancelled:
+                    raise
+                logging.info(f"Retrying {path} after error: {e}")
+                deadline = time.monotonic() + RETRY_DELAY
+                while time.monotonic() < deadline and not self.cancel.cancelled:
+                    time.sleep(CANCEL_POLL)
+
+    def fail_job(self, path, error):
+        # Written by the store stage, the only one that updates the files of the job queue. Once
+        # cancelled the file stays leased and goes back to the queue for the next scan.
+        if self.jobs is not None and not self.cancel.cancelled:
+            self.writer.put(("failed", (path, str(error))))
+
+    def claim(self, task):
+        """True when the task's content is not being encoded yet, otherwise its path waits for the representative."""
+        path, _, hash_val, stat, _, _, _ = task
+        with self.stats_lock:
+            waiting = self.in_flight.get(hash_val)
+            if waiting is None:
+                self.in_flight[hash_val] = []
+                return True
+            waiting.append((path, stat))
+            self.stats["duplicates"] += 1
+        logging.info(f"Image queued: {path} (duplicate content, mapped when its first copy is stored)")
+        return False
+
+    def release(self, hash_val):
+        """Paths waiting for a content, when its encoding fails they are read again by the next scan."""
+        with self.stats_lock:
+            return self.in_flight.pop(hash_val, [])
+
+    def encode_tasks(self, stop):
+        while True:
+            try:
+                task = self.to_encode.get(timeout=CANCEL_POLL)
+            except Empty:
+                if stop.cancelled:
+                    return
+                continue
+            if task is None:
+                self.encode_input_done.set()
+                return
+            yield task
+
+    def feed_stage(self, pool, align, pending, aligned, stop):
+        # Submits one task at a time: a generator handed to imap would hold the pool's task
+        # thread while it waits for a slot, and the embedding batches queued behind it with it
+        submitted = 0
+        try:
+            for task in throttled(self.encode_tasks(stop), pending, stop):
+                pool.apply_async(align, (task,), callback=aligned.put,
+                                 error_callback=lambda e, task=task: aligned.put(AlignFailed(task[0], task[2], e)))
+                submitted += 1
+        except Exception as e:
+            logging.error(f"Error in feed stage: {e}")
+            stop.cancel()
+        finally:
+            aligned.put(FeedDone(submitted))
+
+    def encode_stage(self):
+        # At most pending buffers wait in the pool, the semaphore slot of a task is freed with its result
+        pending = threading.Semaphore(self.workers * ENCODE_QUEUE_PER_WORKER)
+        options = dict(self.encoder_options)
+        jitters = options.pop("jitters")
+        embed = partial(embed_faces, encoder=self.encoder, jitters=jitters)
+        stop = cancellation.CancelToken(self.cancel)
+        aligned = Queue()
+        feeder = None
+        try:
+            with worker_pool.get_pool().use() as pool:
+                batcher = FaceBatcher(pool, embed, self.batch_size, self.workers, self.emit_record, self.release, stop)
+                feeder = threading.Thread(target=self.feed_stage, name="Feed",
+                                          args=(pool, partial(align_buffer, **options), pending, aligned, stop))
+                feeder.start()
+                received, submitted = 0, None
+                while submitted is None or received < submitted:
+                    try:
+                        result = aligned.get(timeout=CANCEL_POLL)
+                    except Empty:
+                        stop.check()
+                        continue
+                    if isinstance(result, FeedDone):
+                        submitted = result.submitted
+                        continue
+                    received += 1
+                    pending.release()
+                    if isinstance(result, AlignFailed):
+                        logging.error(f"Error aligning faces in {result.path}: {result.error}")
+                        self.release(result.hash)
+                        continue
+                    batcher.add(result)
+                stop.check()
+                batcher.close()
+        except cancellation.Cancelled:
+            logging.info("Encode stage cancelled")
+        except Exception as e:
+            logging.error(f"Error in encode stage: {e}")
+            logging.debug(traceback.format_exc())
+        finally:
+            stop.cancel()
+            if feeder is not None:
+                feeder.join()
+            # Drain so the read stage never blocks on a full queue after a failure or a cancel
+            while not self.encode_input_done.is_set():
+                try:
+                    if self.to_encode.get(timeout=CANCEL_POLL) is None:
+                        break
+                except Empty:
+                    pass
+
+    def emit_record(self, record):
+        self.count("encoded")
+        self.writer.put(("record", record))
+
+    def store_batch(self, conn, batch):
+        """Store stage, called by the DBWriter inside its transaction."""
+        if self.jobs is not None:
+            self.jobs.complete([item for kind, item in batch if kind == "exported"])
+            for kind, item in batch:
+                if kind == "failed":
+                    # Already tried within this run
+                    self.jobs.fail([item[0]], item[1], retry=False)
+        batch = [(kind, item) for kind, item in batch if kind in ("record", "indexed")]
+        records = [item for kind, item in batch if kind == "record"]
+        copies = []
+        if records:
+            db.write_records(conn, records, self.encoder)
+            # Copies of the newly encoded contents are mapped to their images
+            copies = [db.Record(path, record.hash, record.num_faces, None, stat)
+                      for record in records if record.encodings is not None
+                      for path, stat in self.release(record.hash)]
+            if copies:
+                db.write_records(conn, copies, self.encoder)
+            self.count("written", len(records) + len(copies))
+            index = near_duplicates.get_index()
+            for record in records:
+                if record.signature is not None:
+                    index.add(record.hash, record.signature)
+        paths, stored = [], []
+        for kind, item in batch + [("record", copy) for copy in copies]:
+            path, num_faces = (item.path, item.num_faces) if kind == "record" else item
+            stored.append(path)
+            if num_faces > 0:
+                paths.append(path)
+        self.count("queued", len(paths))
+        if self.on_queued:
+            for path in paths:
+                self.on_queued(path)
+        matched_paths = []
+        if self.engine is not None and paths:
+            matched_paths = matching.match_paths(paths, self.engine, encoding_store.get_store(self.encoder_id))
+            self.count("matched", len(matched_paths))
+        if self.jobs is not None:
+            # In the same transaction as the records, matched files are done once exported
+            matched = set(matched_paths)
+            self.jobs.complete([path for path in stored if path not in matched])
+        self.matched.extend(matched_paths)
+
+    def export_committed(self, ok):
+        """Called by the DBWriter after each flush: the matches are exported once they are stored."""
+        matched, self.matched = self.matched, []
+        if ok:
+            for path in matched:
+                self.to_export.put(path)
+
+    def export_stage(self):
+        for file_path in iter(self.to_export.get, None):
+            try:
+                if self.output_folder:
+                    self.retried(partial(self.export_file, file_path), file_path)
+                self.count("exported")
+                if self.jobs is not None:
+                    self.writer.put(("exported", file_path))
+                if self.on_match:
+                    self.on_match(file_path)
+            except Exception as e:
+                logging.error(f"Error exporting {file_path}: {e}")
+                self.fail_job(file_path, e)
+
+    def export_file(self, file_path):
+        # Copy file with new name
+        output_file_path = utils.build_matches_file(file_path, self.output_folder)
+        if not os.path.exists(output_file_path):
+            shutil.copy(file_path, output_file_path)
+        else:
+            logging.info(f"File {file_path} already exists")
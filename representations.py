@@ -0,0 +1,211 @@
+import os
+import pickle
+import hashlib
+import logging
+from functools import partial
+from pathlib import Path
+import numpy as np
+
+import config
+import db
+import encoders
+import image_io
+import deepface_search
+import near_duplicates
+
+def pickle_name(encoder):
+    """Name DeepFace.find gives the representation file of a DeepFace encoder's settings."""
+    alignment = "aligned" if encoder.alignment == "aligned" else "unaligned"
+    name = (f"ds_model_{deepface_search.model_name(encoder)}_detector_{encoder.detector}_{alignment}"
+            f"_normalization_{encoder.normalization}_expand_0.pkl")
+    return name.replace("-", "").lower()
+
+def deepface_file_hash(path):
+    """Hash DeepFace keeps per represented file to notice changes, from its size, ctime and mtime."""
+    st = os.stat(path)
+    return hashlib.sha1(f"{st.st_size}-{st.st_ctime}-{st.st_mtime}".encode("utf-8")).hexdigest()
+
+def iter_representations(pickle_path):
+    """Yield (identity, embedding, (top, right, bottom, left) or None, file hash or None) of a representation file.
+
+    Reads the list of dicts of current DeepFace versions and the [identity,
+    embedding] pairs of older ones.
+    """
+    with open(pickle_path, "rb") as f:
+        content = pickle.load(f)
+    if not isinstance(content, list):
+        logging.warning(f"{pickle_path} does not contain a list!")
+        return
+    for item in content:
+        if isinstance(item, dict):
+            box = None
+            if "target_x" in item:
+                x, y, w, h = (int(item[key]) for key in ("target_x", "target_y", "target_w", "target_h"))
+                box = (y, x + w, y + h, x)
+            yield item.get("identity"), item.get("embedding"), box, item.get("hash")
+        elif isinstance(item, (list, tuple)) and len(item) >= 2:
+            yield item[0], item[1], None, None
+
+def find_pickles(root_folder, encoder):
+    """Representation files of the encoder under root_folder."""
+    name = pickle_name(encoder)
+    for dirpath, _, filenames in os.walk(root_folder):
+        if name in filenames:
+            yield os.path.join(dirpath, name)
+
+def import_record(identity, faces, encoder, encoder_id):
+    """Record of an image from its representation file entries, or None when it cannot be trusted or is indexed."""
+    path = str(Path(identity))
+    if not os.path.isfile(path):
+        return None
+    file_hashes = {file_hash for _, _, file_hash in faces if file_hash}
+    if file_hashes and file_hashes != {deepface_file_hash(path)}:
+        # Changed since it was represented, the scan embeds it again
+        return None
+    stat = image_io.file_stat(path)
+    row = db.get_file_state(path, encoder_id)
+    if row is not None and row[:4] == stat and row[5] is not None:
+        return None
+    buffer, hash_val = image_io.read_image(path, stat[0])
+    num_faces = db.get_num_faces(hash_val, encoder_id)
+    if num_faces is not None:
+        return db.Record(path, hash_val, num_faces, None, stat)
+    try:
+        signature = image_io.perceptual_hash(buffer)
+    except Exception as e:
+        logging.warning(f"Error hashing image {path}: {e}")
+        signature = None
+    locations, encodings = [], []
+    for embedding, box, _ in faces:
+        if embedding is None:
+            continue
+        # DeepFace represents the whole image when it finds no face, align drops it
+        if box is not None and signature is not None and box == (0, signature[1][0], signature[1][1], 0):
+            continue
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if encoder.dim and len(embedding) != encoder.dim:
+            logging.warning(f"Embedding of {path} has {len(embedding)} values instead of {encoder.dim}, not imported")
+            return None
+        locations.append(box)
+        encodings.append(embedding)
+    if any(box is None for box in locations):
+        # Faces without boxes (older representation files) are stored without them
+        locations = None
+    return db.Record(path, hash_val, len(encodings), encodings, stat, locations, None, signature)
+
+def write_imported(conn, batch, encoder):
+    db.write_records(conn, batch, encoder)
+    index = near_duplicates.get_index()
+    for record in batch:
+        if record.signature is not None:
+            index.add(record.hash, record.signature)
+
+def import_pickles(root_folder, encoder, cancel=None):
+    """Import the DeepFace representation files found under root_folder into the encoder's store.
+
+    Images listed there are stored with their embeddings so that the scan does
+    not embed them again. A representation file is only imported once, unless
+    it changes. Stops between images once cancel is set, what was read is written.
+    Returns the number of images written.
+    """
+    encoder_id = encoders.get_id(encoder)
+    written = 0
+    for pickle_path in find_pickles(root_folder, encoder):
+        if cancel is not None and cancel.cancelled:
+            break
+        st = os.stat(pickle_path)
+        if db.is_imported(pickle_path, st.st_size, st.st_mtime_ns):
+            continue
+        logging.info(f"Importing DeepFace representations from {pickle_path}")
+        faces = {}
+        try:
+            for identity, embedding, box, file_hash in iter_representations(pickle_path):
+                if identity:
+                    faces.setdefault(identity, []).append((embedding, box, file_hash))
+        except Exception as e:
+            logging.error(f"Error reading {pickle_path}: {e}")
+            continue
+        writer = db.DBWriter(config.DB_BATCH_SIZE, config.DB_FLUSH_MS / 1000,
+                             write=partial(write_imported, encoder=encoder), encoder_id=encoder_id, index=False)
+        writer.start()
+        queued = 0
+        try:
+            for identity, image_faces in faces.items():
+                if cancel is not None and cancel.cancelled:
+                    break
+                try:
+                    record = import_record(identity, image_faces, encoder, encoder_id)
+                except Exception as e:
+                    logging.warning(f"Error importing {identity}: {e}")
+                    continue
+                if record is not None:
+                    writer.put(record)
+                    queued += 1
+        finally:
+            writer.close()
+        written += writer.written
+        # A failed flush is logged by the writer, the file is imported again next time
+        if writer.written == queued and not (cancel is not None and cancel.cancelled):
+            with db.transaction():
+                db.mark_imported(pickle_path, st.st_size, st.st_mtime_ns)
+    if written:
+        logging.info(f"Imported {written} images from DeepFace representation files")
+    return written
+
+def record_key(item):
+    """Cheap identity of a representation entry: its file and face box."""
+    if isinstance(item, dict):
+        return (item.get("identity"), item.get("target_x"), item.get("target_y"),
+                item.get("target_w"), item.get("target_h"))
+    return item[0], None, None, None, None
+
+def build_path_index(root_folder):
+    """Map the normalized path of every file under root_folder to its path on disk, with a single walk."""
+    index = {}
+    for dirpath, _, filenames in os.walk(root_folder):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            index[os.path.normcase(os.path.abspath(path))] = path
+    return index
+
+def iter_pickle_entries(directory_path):
+    """Yield the entries of the representation files of directory_path, one file in memory at a time."""
+    for file_name in sorted(os.listdir(directory_path)):
+        if not file_name.endswith(".pkl"):
+            continue
+        file_path = os.path.join(directory_path, file_name)
+        with open(file_path, "rb") as f:
+            content = pickle.load(f)
+        if not isinstance(content, list):
+            logging.warning(f"Warning: {file_path} does not contain a list!")
+            continue
+        yield from content
+
+def merge_pickles(directory_path, output_file, root_folder=None):
+    """Merge the representation files of directory_path into output_file, each face once.
+
+    Identities are set to the path of the file on disk through an index of
+    root_folder (default directory_path) built once, entries are deduplicated on
+    (identity, face box). Returns the number of entries written.
+    """
+    paths = build_path_index(root_folder or directory_path)
+    seen = set()
+    merged = []
+    for item in iter_pickle_entries(directory_path):
+        identity = item.get("identity") if isinstance(item, dict) else item[0]
+        exact_path = paths.get(os.path.normcase(os.path.abspath(identity))) if identity else None
+        if exact_path is not None and exact_path != identity:
+            if isinstance(item, dict):
+                item["identity"] = exact_path
+            else:
+                item = [exact_path, *item[1:]]
+        key = record_key(item)
+        if key not in seen:
+            seen.add(key)
+            merged.append(item)
+    # Written aside first, output_file may be one of the merged files
+    temp_file = f"{output_file}.tmp"
+    with open(temp_file, "wb") as out:
+        pickle.dump(merged, out, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file, output_file)
+    return len(merged)
@@ -0,0 +1,132 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from PIL import Image
+
+import db
+import image_io
+
+THUMBNAIL_WIDTH = 200
+JPEG_QUALITY = 85
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def thumbnails_dir():
+    return f"{os.path.splitext(db.DB_PATH)[0]}_thumbnails"
+
+def thumbnail_path(hash_val, width=THUMBNAIL_WIDTH):
+    return os.path.join(thumbnails_dir(), hash_val[:2], f"{hash_val}_{width}.jpg")
+
+def content_hash(file_path):
+    """Content hash of a file, from the last scan while its stat is unchanged."""
+    stat = image_io.file_stat(file_path)
+    try:
+        row = db.get_path_state(str(Path(file_path)))
+    except Exception as e:
+        logging.warning(f"Database error for {file_path}: {e}")
+        row = None
+    if row is not None and row[:4] == stat and row[4]:
+        return row[4]
+    return image_io.read_image(file_path, stat[0])[1]
+
+class ThumbnailCache:
+    """Thumbnails of image files, keyed by content hash.
+
+    Thumbnails are kept in an in-memory LRU holding at most max_bytes of pixels,
+    backed by JPEG files next to the database. Missing ones are made by a single
+    background thread so the caller (the Tk thread) never decodes a full image.
+    """
+
+    def __init__(self, max_bytes, width=THUMBNAIL_WIDTH):
+        self.max_bytes = max_bytes
+        self.width = width
+        self.images = OrderedDict()
+        self.bytes = 0
+        self.hashes = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Thumbnails")
+
+    def get(self, file_path):
+        """Thumbnail of file_path, or None while it is being made in the background.
+
+        Raises the error of a failed generation once.
+        """
+        with self.lock:
+            hash_val = self.hashes.get(file_path)
+            if hash_val in self.images:
+                self.pending.pop(file_path, None)
+                self.images.move_to_end(hash_val)
+                return self.images[hash_val]
+            future = self.pending.get(file_path)
+            if future is None:
+                self.pending[file_path] = self.executor.submit(self.load, file_path)
+                return None
+            if not future.done():
+                return None
+            del self.pending[file_path]
+        # Raises when the thumbnail could not be made, otherwise it is in memory now
+        return future.result()
+
+    def load(self, file_path):
+        hash_val = content_hash(file_path)
+        with self.lock:
+            if hash_val in self.images:
+                self.hashes[file_path] = hash_val
+                return self.images[hash_val]
+        path = thumbnail_path(hash_val, self.width)
+        image = None
+        if os.path.exists(path):
+            try:
+                with Image.open(path) as stored:
+                    image = stored.convert("RGB")
+            except Exception as e:
+                logging.warning(f"Error reading thumbnail {path}: {e}")
+        if image is None:
+            image = image_io.make_thumbnail(file_path, self.width)
+            self.save(image, path)
+        self.put(file_path, hash_val, image)
+        return image
+
+    def save(self, image, path):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.tmp"
+            image.save(temp_path, "JPEG", quality=JPEG_QUALITY)
+            os.replace(temp_path, path)
+        except Exception as e:
+            logging.warning(f"Error saving thumbnail {path}: {e}")
+
+    def put(self, file_path, hash_val, image):
+        size = image.width * image.height * len(image.getbands())
+        with self.lock:
+            self.hashes[file_path] = hash_val
+            if hash_val not in self.images:
+                self.images[hash_val] = image
+                self.bytes += size
+            while self.bytes > self.max_bytes and len(self.images) > 1:
+                _, evicted = self.images.popitem(last=False)
+                self.bytes -= evicted.width * evicted.height * len(evicted.getbands())
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+def get_cache():
+    """Thumbnail cache of the application, created on first use."""
+    global _cache
+    import config
+    with _cache_lock:
+        if _cache is None:
+            _cache = ThumbnailCache(config.THUMBNAIL_CACHE_MB * 1024 * 1024)
+        return _cache
+
+def shutdown():
+    global _cache
+    with _cache_lock:
+        cache, _cache = _cache, None
+    if cache is not None:
+        cache.close()
@@ -59,6 +59,12 @@ def add_suffix(file_name, suffix):
     new_file_name = f"{name}_{suffix}.{ext}"
     return new_file_name
     
+def build_matches_file(file_path,output_folder):
+    parent_folder = os.path.basename(os.path.dirname(file_path))
+    file_name = os.path.basename(file_path)
+    new_file_name = f"{parent_folder}_{file_name}"
+    return os.path.join(output_folder, new_file_name)
+
 def path_exists(a_path):
     return os.path.exists(a_path)
  
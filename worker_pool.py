@@ -0,0 +1,108 @@
+import os
+import logging
+import threading
+from contextlib import contextmanager
+from multiprocessing import Pool
+import psutil
+import setproctitle
+
+import config
+import db
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def init_worker(preload_deepface=False):
+    """Pool initializer: name the process, open its connection and load the models once."""
+    setproctitle.setproctitle(f"face_worker_{os.getpid()}")
+    db.init_worker()
+    # face_recognition loads the dlib models when it is imported
+    import face_recognition
+    if preload_deepface:
+        import encoders, deepface_search
+        try:
+            deepface_search.get_model(encoders.deepface_encoder())
+        except Exception as e:
+            logging.error(f"Error preloading the DeepFace model: {e}")
+
+class WorkerPool:
+    """Process pool started once and shared by the scans, re-encodes and comparisons.
+
+    Operations borrow the pool with use(). When the last one returns, workers whose
+    resident memory grew over max_rss_mb get the pool recycled: the idle pool is
+    closed and a new warm one started, so no task is ever lost.
+    """
+
+    def __init__(self, workers=None, max_rss_mb=None, preload_deepface=None):
+        self.workers = workers or config.WORKERS
+        self.max_rss_mb = config.WORKER_MAX_RSS_MB if max_rss_mb is None else max_rss_mb
+        self.preload_deepface = config.PRELOAD_DEEPFACE if preload_deepface is None else preload_deepface
+        self.lock = threading.Lock()
+        self.active = 0
+        self.pool = self.start()
+
+    def start(self):
+        logging.info(f"Starting {self.workers} worker processes")
+        return Pool(processes=self.workers, initializer=init_worker, initargs=(self.preload_deepface,))
+
+    @contextmanager
+    def use(self):
+        with self.lock:
+            self.active += 1
+            pool = self.pool
+        try:
+            yield pool
+        finally:
+            with self.lock:
+                self.active -= 1
+                if self.active == 0:
+                    self.check()
+
+    def worker_rss_mb(self):
+        """Resident memory of each worker process, as {pid: MB}."""
+        rss = {}
+        # Pool keeps its worker processes in _pool, it replaces the ones that exit
+        for process in list(self.pool._pool):
+            try:
+                rss[process.pid] = psutil.Process(process.pid).memory_info().rss / 1024 / 1024
+            except (psutil.Error, TypeError):
+                continue
+        return rss
+
+    def check(self):
+        """Recycle the pool when a worker is over the memory limit, called with the lock held and the pool idle."""
+        if not self.max_rss_mb:
+            return
+        over = {pid: rss for pid, rss in self.worker_rss_mb().items() if rss > self.max_rss_mb}
+        if not over:
+            return
+        logging.info(f"Recycling the worker pool, workers over {self.max_rss_mb} MB: "
+                     + ", ".join(f"{pid} ({rss:.0f} MB)" for pid, rss in over.items()))
+        old = self.pool
+        self.pool = self.start()
+        old.close()
+        old.join()
+
+    def close(self, terminate=False):
+        """Stop the workers once their tasks are done, or right away with terminate."""
+        with self.lock:
+            if terminate:
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+
+def get_pool():
+    """Return the application's worker pool, starting it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool()
+        return _pool
+
+def shutdown(terminate=False):
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.close(terminate)